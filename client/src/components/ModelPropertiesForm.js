@@ -7,6 +7,7 @@ const ModelPropertiesForm = ({
   jobId,
   setJobId,
   setJobStatus,
+  fetchResult,
   disabled,
 }) => {
   const fetchJobId = async ({
@@ -34,9 +35,16 @@ const ModelPropertiesForm = ({
         isError: false,
         jobId: result.data.jobId,
       });
+      // an identical earlier request may already be running or finished,
+      // its job is then followed instead of a new one
       setJobStatus({
-        status: "job_queued",
+        status: result.data.status || "job_queued",
+        progress: result.data.progress,
+        total: result.data.total,
       });
+      if (result.data.state === "finished") {
+        fetchResult(result.data.jobId);
+      }
     } catch (err) {
       setJobId({
         ...jobId,
@@ -95,7 +103,7 @@ const ModelPropertiesForm = ({
               </label>
             </div>
           </div>
-          <p className="help is-gray mb-1">Large CSV files are automatically truncated to the first 10,000 rows</p>
+          <p className="help is-gray mb-1">Very large CSV files may be truncated to the server's configured row limit</p>
           <button
             type="submit"
             form="csv-prop"
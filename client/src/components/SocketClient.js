@@ -2,6 +2,8 @@ const SocketClient = ({ jobId, jobStatus }) => {
   const getCurrentStatus = (status) => {
     if (status === "cause_effect") {
       return "Running causal model...";
+    } else if (status === "load_claims") {
+      return "Loading claims...";
     } else if (status === "create_clusters") {
       return "Creating entity clusters...";
     } else if (status === "finished") {
@@ -18,6 +18,38 @@ import Message from "../components/Message";
 
 let socket;
 
+const PAGE_SIZE = 5000;
+const POLL_INTERVAL = 1000;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+// poll a queued job until it finishes, reporting its status on the way
+const waitForJob = async (jobId, onStatus) => {
+  while (true) {
+    const result = await axios.get(`${API_URL}/job/${jobId}`);
+    onStatus(result.data);
+    if (result.data.state === "finished") return result.data.result;
+    if (result.data.state === "failed")
+      throw new Error(result.data.error || "job failed");
+    await sleep(POLL_INTERVAL);
+  }
+};
+
+// fetch every slice of a stored job result
+const fetchResultPart = async (jobId, part) => {
+  let items = [];
+  let total = 0;
+  do {
+    const result = await axios.get(`${API_URL}/graph/${jobId}/${part}`, {
+      params: { offset: items.length, limit: PAGE_SIZE },
+    });
+    if (result.data.items.length === 0) break;
+    items = items.concat(result.data.items);
+    total = result.data.total;
+  } while (items.length < total);
+  return items;
+};
+
 function Home() {
   const [jobId, setJobId] = useState({ isLoading: false, isError: false });
   const [jobStatus, setJobStatus] = useState({});
@@ -60,21 +92,39 @@ function Home() {
           total: parsedData["total"],
         });
 
-        if (parsedData.status === "finished") {
-          dispatchGraph({
-            type: "FETCH_SUCCESS_INIT",
-            payload: {
-              data: JSON.parse(parsedData["result_df"]),
-              claims: JSON.parse(parsedData["claims_df"]),
-              clustered: parsedData["cluster"],
-              topics: parsedData["topics"],
-            },
-          });
+        // a re-clustering of the graph reports here too, its result is
+        // fetched by submitClusterForm once the job is done
+        if (parsedData.status === "finished" && !parsedData.clusterJobId) {
+          fetchResult(parsedData["jobId"]);
         }
       });
     }
   };
 
+  const fetchResult = async (resultJobId) => {
+    dispatchGraph({ type: "FETCH_INIT" });
+    try {
+      const summary = await axios.get(`${API_URL}/graph/${resultJobId}`);
+      const [data, claims] = await Promise.all([
+        fetchResultPart(resultJobId, "edges"),
+        fetchResultPart(resultJobId, "claims"),
+      ]);
+
+      dispatchGraph({
+        type: "FETCH_SUCCESS_INIT",
+        payload: {
+          data: data,
+          claims: claims,
+          clustered: summary.data["cluster"],
+          topics: summary.data["topics"],
+        },
+      });
+    } catch (err) {
+      dispatchGraph({ type: "FETCH_FAILURE" });
+      toast.error(`Error: ${err.message}`);
+    }
+  };
+
   const submitClusterForm = async (event) => {
     event.preventDefault();
     setClusterFormLoading(true);
@@ -91,14 +141,27 @@ function Home() {
         data.n_gram_range = [ngram_range_min || 1, ngram_range_max || 2];
       if (top_n_words) data.top_n_words = top_n_words;
 
-      data.graph = JSON.stringify(graph.claims);
+      // clustering runs as a job on the stored claims of the graph
+      data.graph_id = jobId.jobId;
       result = await axios.post(`${API_URL}/cluster`, data);
 
+      const clusterJob = await waitForJob(result.data["jobId"], (status) =>
+        setJobStatus({
+          status: status["status"],
+          progress: status["progress"],
+          total: status["total"],
+        })
+      );
+      const [summary, clusterData] = await Promise.all([
+        axios.get(`${API_URL}/graph/${clusterJob["jobId"]}`),
+        fetchResultPart(clusterJob["jobId"], "edges"),
+      ]);
+
       dispatchGraph({
         type: "FETCH_SUCCESS_CLUSTER",
         payload: {
-          data: JSON.parse(result.data["result_df"]),
-          topics: result.data["topics"],
+          data: clusterData,
+          topics: summary.data["topics"],
         },
       });
       setClusterFormLoading(false);
@@ -172,6 +235,7 @@ function Home() {
                 jobId={jobId}
                 setJobId={setJobId}
                 setJobStatus={setJobStatus}
+                fetchResult={fetchResult}
                 disabled={isJobSubmitted || !isCSVFileUploaded}
               />
             </div>
@@ -1,7 +1,10 @@
 import os
+import re
 import ast
 import csv
 import json
+import hashlib
+from uuid import uuid4
 from flask import Flask, send_from_directory
 from flask_cors import CORS
 from flask_restful import Resource, Api, reqparse, inputs
@@ -12,10 +15,14 @@ from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 from rq import Queue
 from rq.job import Job
+from rq.exceptions import NoSuchJobError
 from redis import Redis
+from redis.exceptions import WatchError
 
-from jobs import create_causal_graph
-from topic_model import create_clustered_graph_json
+from cache import model_version
+from config import SAVED_MODEL_PATH, MODEL_BACKEND
+from jobs import cluster_graph, create_sharded_graph
+from results import RESULT_PARTS, load_part, load_summary, result_path
 
 load_dotenv(find_dotenv())
 
@@ -43,6 +50,13 @@ DOWNLOAD_FOLDER = env('DOWNLOAD_FOLDER')
 REDIS_HOST = env('REDIS_HOST')
 REDIS_PORT = env('REDIS_PORT')
 ALLOWED_EXTENSIONS = {'csv'}
+MAX_PAGE_SIZE = 10000
+# identical graph requests share one job and its result for this long
+COALESCE_TTL = 7 * 24 * 60 * 60
+# job states an identical graph request can still join
+JOINABLE_STATES = {'queued', 'deferred', 'scheduled', 'started'}
+# name of an upload stored under the digest of its content
+UPLOAD_NAME = re.compile(r'[0-9a-f]{64}\.csv')
 
 socketio = SocketIO(app, message_queue=f"redis://{REDIS_HOST}:{REDIS_PORT}", cors_allowed_origins="*")
 
@@ -55,6 +69,93 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def save_upload(upload, upload_dir):
+    # uploads are stored under the digest of their content, so a file name
+    # always stands for the same rows and no upload replaces another one.
+    # the content is hashed while it is written, yielding to the event loop
+    # between blocks so that a large file does not stall the other clients
+    tmp_path = os.path.join(upload_dir, f".{uuid4().hex}.tmp")
+    digest = hashlib.sha256()
+    with open(tmp_path, 'wb') as f:
+        for block in iter(lambda: upload.stream.read(1 << 20), b''):
+            digest.update(block)
+            f.write(block)
+            socketio.sleep(0)
+
+    filename = f"{digest.hexdigest()}.csv"
+    path = os.path.join(upload_dir, filename)
+    if os.path.exists(path):
+        # the same content again, the file jobs may be reading stays as is
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return filename
+
+
+def graph_job_key(digest, column_name, cluster, preprocess, base_job_id):
+    # the same rows with the same options and model give the same graph,
+    # whatever name the file was uploaded under. the backends do not agree
+    # on every tag, so they do not share graphs
+    params = json.dumps([
+        digest,
+        column_name,
+        cluster,
+        preprocess,
+        base_job_id,
+        model_version(SAVED_MODEL_PATH),
+        MODEL_BACKEND,
+    ])
+    return f"graph_job_by_content:{hashlib.sha256(params.encode()).hexdigest()}"
+
+
+def claim_job_key(key, job_id, stale_id=None):
+    # a free key is claimed with SET NX, the key of a failed or expired job
+    # only if no other request replaced it in the meantime
+    if stale_id is None:
+        return redis_conn.set(key, job_id, nx=True, ex=COALESCE_TTL)
+    with redis_conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) != stale_id:
+                return False
+            pipe.multi()
+            pipe.set(key, job_id, ex=COALESCE_TTL)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+def resolve_result_job(job):
+    # a sharded job is done once its merge job is
+    if 'merge_job' not in job.meta:
+        return job
+    # a shard that failed all of its retries leaves the merge job waiting
+    shards = Job.fetch_many(job.meta['shards'], connection=redis_conn)
+    failed = [shard for shard in shards if shard is not None and shard.is_failed]
+    if failed:
+        return failed[0]
+    return Job.fetch(job.meta['merge_job'], connection=redis_conn)
+
+
+def job_info(job):
+    result_job = resolve_result_job(job)
+    state = result_job.get_status()
+    info = {
+        'jobId': job.id,
+        'state': state,
+        'status': job.meta.get('status', 'job_queued'),
+        'progress': job.meta.get('progress'),
+        'total': job.meta.get('total'),
+        'queuePosition': job.get_position(),
+    }
+    if state == 'finished':
+        info['result'] = result_job.result
+    elif state == 'failed' and result_job.exc_info:
+        info['error'] = result_job.exc_info.strip().splitlines()[-1]
+    return info
+
+
 def send_progress_update(data, job):
     socketio.emit(
         'job_status',
@@ -63,6 +164,17 @@ def send_progress_update(data, job):
     )
 
 
+def send_cluster_progress_update(data, job):
+    # a cluster job also reports to the room of the graph it re-clusters,
+    # which is the room the client already joined
+    send_progress_update(data, job)
+    socketio.emit(
+        'job_status',
+        json.dumps({**data, 'clusterJobId': job.id}),
+        to=job.meta['graph_id']
+    )
+
+
 class File(Resource):
     def get(self, filename):
         response = send_from_directory(
@@ -80,8 +192,7 @@ class File(Resource):
         csv_file = args['file']
 
         if allowed_file(csv_file.filename):
-            filename = secure_filename(csv_file.filename)
-            csv_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            filename = save_upload(csv_file, app.config['UPLOAD_FOLDER'])
 
             # read column names
             column_names = None
@@ -108,44 +219,111 @@ class Graph(Resource):
         parser.add_argument('column_name', required=True, location='args')
         parser.add_argument('cluster', default=False, type=inputs.boolean, location='args')
         parser.add_argument('preprocess', default=False, type=inputs.boolean, location='args')
+        parser.add_argument('base_job_id', location='args')
 
         args = parser.parse_args()
-        file_name = args['file_name']
+        file_name = secure_filename(args['file_name'])
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_name)
         column_name = args['column_name']
         cluster = args['cluster']
         preprocess = args['preprocess']
+        save_dir = os.path.join(app.root_path, DOWNLOAD_FOLDER)
+        if not os.path.exists(file_path):
+            return json_response(status_=404, status='failure', message='file not found')
+
+        # the rows may extend the graph of an earlier job
+        base_job_id = args['base_job_id']
+        if base_job_id is not None:
+            base_job_id = secure_filename(base_job_id)
+            if not os.path.exists(result_path(save_dir, base_job_id, 'claims')):
+                return json_response(status_=404, status='failure', message='base graph not found')
+
+        # an identical request is joined while its job is queued or running
+        # and served from the stored result once that job has finished.
+        # files uploaded under their own name, before uploads were stored
+        # by content, may have been replaced and are never coalesced
+        key = None
+        if UPLOAD_NAME.fullmatch(file_name):
+            key = graph_job_key(file_name[:-len('.csv')], column_name, cluster, preprocess, base_job_id)
+        for _ in range(3):
+            stale_id = redis_conn.get(key) if key is not None else None
+            if stale_id is not None:
+                existing_id = stale_id.decode()
+                if load_summary(save_dir, existing_id) is not None:
+                    return json_response(
+                        jobId=existing_id,
+                        state='finished',
+                        status='finished',
+                        coalesced=True
+                    )
+                try:
+                    existing = Job.fetch(existing_id, connection=redis_conn)
+                    info = job_info(existing)
+                except NoSuchJobError:
+                    info = None
+                if info is not None and info['state'] in JOINABLE_STATES:
+                    return json_response(**info, coalesced=True)
+
+            # Enqueue job
+            # large uploads are split into shards, smaller ones run in this job
+            job = Job.create(
+                create_sharded_graph,
+                args=(
+                    file_path,
+                    column_name,
+                    send_progress_update
+                ),
+                kwargs={
+                    'cluster': cluster,
+                    'preprocess': preprocess,
+                    'save_dir': save_dir,
+                    'base_graph_id': base_job_id,
+                },
+                timeout='30m',
+                connection=redis_conn
+            )
+            # another request claiming the key first is joined on the next try
+            if key is None or claim_job_key(key, job.id, stale_id):
+                break
 
-        # Enqueue job
-        job = Job.create(
-            create_causal_graph,
-            args=(
-                os.path.join(app.config['UPLOAD_FOLDER'], file_name),
-                column_name,
-                send_progress_update
-            ),
-            kwargs={
-                'cluster': cluster,
-                'preprocess': preprocess,
-                'save_dir': os.path.join(app.root_path, DOWNLOAD_FOLDER),
-            },
-            timeout='30m',
-            connection=redis_conn
-        )
         result_job = redis_queue.enqueue_job(job)
 
         return json_response(jobId=result_job.id, queuePosition=result_job.get_position())
 
 
+class GraphResult(Resource):
+    def get(self, job_id, part=None):
+        save_dir = os.path.join(app.root_path, DOWNLOAD_FOLDER)
+        job_id = secure_filename(job_id)
+
+        if part is None:
+            summary = load_summary(save_dir, job_id)
+            if summary is None:
+                return json_response(status_=404, status='failure', message='result not found')
+            return json_response(**summary)
+
+        if part not in RESULT_PARTS or not os.path.exists(result_path(save_dir, job_id, part)):
+            return json_response(status_=404, status='failure', message='result not found')
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('offset', default=0, type=inputs.natural, location='args')
+        parser.add_argument('limit', default=1000, type=inputs.int_range(1, MAX_PAGE_SIZE), location='args')
+        args = parser.parse_args()
+
+        items, total = load_part(save_dir, job_id, part, args['offset'], args['limit'])
+        return json_response(items=items, offset=args['offset'], total=total)
+
+
 class Cluster(Resource):
     def post(self):
         parser = reqparse.RequestParser()
-        parser.add_argument('graph', required=True, location='json')
+        parser.add_argument('graph_id', required=True, location='json')
         parser.add_argument('nr_topics', location='json', type=int, default=0)
         parser.add_argument('n_gram_range', location='json', action='append', type=int)
         parser.add_argument('top_n_words', location='json', type=int, default=10)
 
         args = parser.parse_args()
-        graph = args['graph']
+        graph_id = secure_filename(args['graph_id'])
         nr_topics = args['nr_topics']
         top_n_words = args['top_n_words']
         n_gram_range = args['n_gram_range']
@@ -163,14 +341,43 @@ class Cluster(Resource):
         elif nr_topics == -1:
             nr_topics = None
 
-        result_df, topics = create_clustered_graph_json(
-            graph=graph,
-            nr_topics=nr_topics,
-            n_gram_range=n_gram_range,
-            top_n_words=top_n_words
+        save_dir = os.path.join(app.root_path, DOWNLOAD_FOLDER)
+        if not os.path.exists(result_path(save_dir, graph_id, 'claims')):
+            return json_response(status_=404, status='failure', message='graph not found')
+
+        # Enqueue job
+        job = Job.create(
+            cluster_graph,
+            args=(
+                graph_id,
+                send_cluster_progress_update
+            ),
+            kwargs={
+                'nr_topics': nr_topics,
+                'n_gram_range': n_gram_range,
+                'top_n_words': top_n_words,
+                'save_dir': save_dir,
+            },
+            timeout='30m',
+            connection=redis_conn
         )
+        result_job = redis_queue.enqueue_job(job)
+
+        return json_response(
+            jobId=result_job.id,
+            queuePosition=result_job.get_position(),
+            statusUrl=api.url_for(JobInfo, job_id=result_job.id)
+        )
+
+
+class JobInfo(Resource):
+    def get(self, job_id):
+        try:
+            job = Job.fetch(job_id, connection=redis_conn)
+        except NoSuchJobError:
+            return json_response(status_=404, status='failure', message='job not found')
 
-        return json_response(result_df=result_df, topics=topics)
+        return json_response(**job_info(job))
 
 
 # @api.representation('text/csv')
@@ -198,4 +405,6 @@ def on_leave(data):
 
 api.add_resource(File, '/api/file/<string:filename>', '/api/file')
 api.add_resource(Graph, '/api/graph')
+api.add_resource(GraphResult, '/api/graph/<string:job_id>', '/api/graph/<string:job_id>/<string:part>')
 api.add_resource(Cluster, '/api/cluster')
+api.add_resource(JobInfo, '/api/job/<string:job_id>')
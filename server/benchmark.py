@@ -0,0 +1,307 @@
+import time
+import random
+import argparse
+import numpy as np
+import pandas as pd
+
+from config import SAVED_MODEL_PATH, NUM_THREADS, ONNX_MODEL_PATH
+from relation_identification import final_result
+
+
+class CountingTokenizer:
+    # wraps a tokenizer and counts how often it is called
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.tokenizer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
+def load_texts(file_path, column_name, rows):
+    df = pd.read_csv(file_path, usecols=[column_name], nrows=rows)
+    return df[column_name].values.tolist()
+
+
+def legacy_tokenize(tokenizer, text):
+    from nltk.tokenize import sent_tokenize
+
+    # tokenizer call pattern of run_prediction before encodings were shared
+    if len(tokenizer(text).tokens()) > 256:
+        sentences = [str(sentence) for sentence in sent_tokenize(text)]
+    else:
+        sentences = [text]
+
+    for sentence in sentences:
+        tokenizer(sentence, truncation=True).tokens()
+        tokenizer(sentence, truncation=True).word_ids()
+        tokenizer(sentence, truncation=True, return_tensors="pt").input_ids
+
+
+def report(name, calls, elapsed, rows):
+    print(
+        f"{name:<24} {calls / rows:6.2f} calls/row "
+        f"{1000 * elapsed / rows:8.3f} ms/row"
+    )
+
+
+def benchmark_tokenizer(args):
+    import torch
+    from transformers import AutoTokenizer
+    from predictor import Predictor, prepare_text
+
+    class ZeroLogitsModel(torch.nn.Module):
+        # stands in for the classifier so only tokenization and
+        # post-processing are timed
+        def forward(self, input_ids, attention_mask=None):
+            return (torch.zeros(*input_ids.shape, 7),)
+
+    texts = load_texts(args.file, args.column, args.rows)
+    tokenizer = CountingTokenizer(
+        AutoTokenizer.from_pretrained(SAVED_MODEL_PATH, add_prefix_space=True)
+    )
+    predictor = Predictor(
+        model=ZeroLogitsModel(),
+        tokenizer=tokenizer,
+        device=torch.device("cpu")
+    )
+
+    # only english, non-empty rows reach the tokenizer
+    prepared = [prepare_text(text, args.preprocess) for text in texts]
+    texts = [text for text, language in prepared if language == 'en']
+    if not texts:
+        raise ValueError("No english rows to benchmark")
+
+    start = time.perf_counter()
+    for text in texts:
+        legacy_tokenize(tokenizer, text)
+    report("before", tokenizer.calls, time.perf_counter() - start, len(texts))
+
+    tokenizer.calls = 0
+    start = time.perf_counter()
+    for text in texts:
+        predictor.run_prediction(text, False)
+    report("run_prediction", tokenizer.calls, time.perf_counter() - start, len(texts))
+
+    tokenizer.calls = 0
+    start = time.perf_counter()
+    predictor.run_prediction_batch(texts, False)
+    report("run_prediction_batch", tokenizer.calls, time.perf_counter() - start, len(texts))
+
+
+def generate_tag_sequences(count, min_length, max_length, seed):
+    # random tag sequences over a vocabulary dense in conjunctions
+    rng = random.Random(seed)
+    vocab = ['a', 'b', 'c', 'the', ',', ';', 'and', 'or', 'plus', 'also', 'of', 'to', 'then']
+    corpus = []
+    for _ in range(count):
+        length = rng.randint(min_length, max_length)
+        ls = []
+        while len(ls) < length:
+            if rng.random() < 0.4:
+                ls.append(0)
+                continue
+            begin = rng.choice([1, 3, 5] if rng.random() < 0.3 else [1, 3])
+            ls += [begin] + [begin + 1] * (rng.randint(1, 3) - 1)
+        corpus.append((ls[:length], [rng.choice(vocab) for _ in range(length)]))
+    return corpus
+
+
+def run_final_result(ls, sw, final_result=final_result):
+    try:
+        return final_result(ls, sw)
+    except Exception as e:
+        return type(e)
+
+
+def benchmark_final_result(args):
+    corpus = generate_tag_sequences(args.count, args.min_length, args.max_length, args.seed)
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for ls, sw in corpus:
+            run_final_result(ls, sw)
+        elapsed = time.perf_counter() - start
+        print(f"{len(corpus) / elapsed:10.1f} sequences/s {1e6 * elapsed / len(corpus):10.1f} us/sequence")
+
+
+def tag_texts(predictor, encodings, batch_size):
+    tags = [None] * len(encodings)
+    for indices, tagged in predictor._tag_batch(encodings, batch_size):
+        for i, (_, word_tags) in zip(indices, tagged):
+            tags[i] = word_tags
+    return tags
+
+
+def benchmark_backends(args):
+    import torch
+    from transformers import AutoTokenizer
+    from model import RobertaForTokenClassification, load_backend
+    from predictor import Predictor, prepare_text
+
+    torch.set_num_threads(args.threads)
+    texts = load_texts(args.file, args.column, args.rows)
+    tokenizer = AutoTokenizer.from_pretrained(SAVED_MODEL_PATH, add_prefix_space=True)
+    model = RobertaForTokenClassification.from_pretrained(SAVED_MODEL_PATH).eval()
+    device = torch.device("cpu")
+
+    reference = None
+    for backend in args.backends:
+        predictor = Predictor(
+            model=load_backend(model, backend, args.threads, args.onnx_path),
+            tokenizer=tokenizer,
+            device=device
+        )
+        if reference is None:
+            prepared = [prepare_text(text, args.preprocess) for text in texts]
+            texts = [text for text, language in prepared if language == 'en']
+            if not texts:
+                raise ValueError("No english rows to benchmark")
+            encodings = predictor._encode(texts, truncation=True)
+
+        # the first backend is the reference the others are checked against
+        tags = tag_texts(predictor, encodings, max(args.batch_sizes))
+        if reference is None:
+            reference = tags
+        words = sum(len(expected) for expected in reference)
+        agreeing = sum((expected == found).sum() for expected, found in zip(reference, tags))
+        identical = sum(np.array_equal(expected, found) for expected, found in zip(reference, tags))
+        print(
+            f"{backend:<6} tag agreement {100 * agreeing / words:7.3f}% "
+            f"identical rows {100 * identical / len(texts):7.3f}%"
+        )
+
+        for batch_size in args.batch_sizes:
+            start = time.perf_counter()
+            tag_texts(predictor, encodings, batch_size)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{backend:<6} batch {batch_size:>4} "
+                f"{len(texts) / elapsed:8.2f} rows/s {1000 * elapsed / len(texts):8.3f} ms/row"
+            )
+
+
+def legacy_create_graph(roberta_df):
+    from topic_model import preprocess
+
+    # create_graph as it was before graph assembly was vectorized, kept as
+    # the reference
+    pairs = roberta_df['pairs'].values.tolist()
+    result = []
+    for i, pair in enumerate(pairs):
+        for relation in pair:
+            cause = relation[0]
+            effect = relation[1]
+
+            processed_cause = preprocess(cause)
+            processed_effect = preprocess(effect)
+
+            if processed_cause and processed_effect:
+                text = roberta_df.iloc[i]['text']
+                result.append([cause, processed_cause, effect, processed_effect, text])
+
+    result_df = pd.DataFrame(
+        result,
+        columns=['cause', 'cause_cluster', 'effect', 'effect_cluster', 'text']
+    )
+    result_df['id'] = result_df.index.values
+    return result_df
+
+
+def generate_claims(relations, entities, seed):
+    # claims with one to five relations over a fixed pool of entities, so
+    # that entities repeat as they do in real data
+    rng = random.Random(seed)
+    words = ['rain', 'the', 'flood', 'of', 'heat', 'prices', 'higher', 'a', 'crop', 'loss', 'demand', 'supply']
+    pool = [
+        ' '.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        for _ in range(entities)
+    ]
+    texts = []
+    pairs = []
+    count = 0
+    while count < relations:
+        pair = [[rng.choice(pool), rng.choice(pool)] for _ in range(rng.randint(1, 5))]
+        texts.append(f"claim {len(texts)}")
+        pairs.append(pair)
+        count += len(pair)
+    return pd.DataFrame({'text': texts, 'pairs': pairs})
+
+
+def benchmark_graph(args):
+    import topic_model
+
+    claims_df = generate_claims(args.relations, args.entities, args.seed)
+    relations = sum(len(pair) for pair in claims_df['pairs'])
+
+    topic_model.normalize_entity.cache_clear()
+    start = time.perf_counter()
+    expected = legacy_create_graph(claims_df)
+    legacy_time = time.perf_counter() - start
+
+    topic_model.normalize_entity.cache_clear()
+    start = time.perf_counter()
+    result = topic_model.create_graph(claims_df)
+    vectorized_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(result, expected)
+    print(f"claims:      {len(claims_df)}")
+    print(f"relations:   {relations}")
+    print(f"edges:       {len(result)}")
+    print(f"loop:        {legacy_time:.3f}s")
+    print(f"vectorized:  {vectorized_time:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the causal claims pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    tokenizer_parser = subparsers.add_parser(
+        "tokenizer",
+        help="tokenizer calls and time per row, before and after sharing encodings"
+    )
+    tokenizer_parser.add_argument("--file", required=True)
+    tokenizer_parser.add_argument("--column", required=True)
+    tokenizer_parser.add_argument("--rows", type=int, default=1000)
+    tokenizer_parser.add_argument("--preprocess", action="store_true")
+    tokenizer_parser.set_defaults(run=benchmark_tokenizer)
+
+    final_result_parser = subparsers.add_parser(
+        "final-result",
+        help="final_result throughput on generated tag sequences"
+    )
+    final_result_parser.add_argument("--count", type=int, default=10000)
+    final_result_parser.add_argument("--min-length", type=int, default=3)
+    final_result_parser.add_argument("--max-length", type=int, default=40)
+    final_result_parser.add_argument("--seed", type=int, default=0)
+    final_result_parser.add_argument("--repeat", type=int, default=3)
+    final_result_parser.set_defaults(run=benchmark_final_result)
+
+    backends_parser = subparsers.add_parser(
+        "backends",
+        help="tag agreement and throughput of the inference backends"
+    )
+    backends_parser.add_argument("--file", required=True)
+    backends_parser.add_argument("--column", required=True)
+    backends_parser.add_argument("--rows", type=int, default=500)
+    backends_parser.add_argument("--preprocess", action="store_true")
+    backends_parser.add_argument("--backends", nargs="+", default=["eager", "int8", "onnx"])
+    backends_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    backends_parser.add_argument("--threads", type=int, default=NUM_THREADS)
+    backends_parser.add_argument("--onnx-path", default=ONNX_MODEL_PATH)
+    backends_parser.set_defaults(run=benchmark_backends)
+
+    graph_parser = subparsers.add_parser(
+        "graph",
+        help="create_graph against the row by row reference on generated claims"
+    )
+    graph_parser.add_argument("--relations", type=int, default=100000)
+    graph_parser.add_argument("--entities", type=int, default=20000)
+    graph_parser.add_argument("--seed", type=int, default=0)
+    graph_parser.set_defaults(run=benchmark_graph)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def model_version(model_path):
+    # fingerprint of a saved model: the contents of its small config files
+    # and the size and mtime of everything else, so that the weights are
+    # never read. computed once per process
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(model_path)):
+        file_path = os.path.join(model_path, name)
+        if not os.path.isfile(file_path):
+            continue
+        digest.update(name.encode())
+        if name.endswith('.json'):
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+        else:
+            stat = os.stat(file_path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Persistent cache of run_prediction results in a local SQLite file.
+
+    Entries are keyed by the text, the preprocess flag and the model version,
+    and the least recently used entries are evicted once the cache holds
+    more than max_entries.
+    """
+
+    def __init__(self, path, version, max_entries):
+        self.version = version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS predictions_accessed ON predictions (accessed)"
+        )
+        self.conn.commit()
+
+    def key(self, text, preprocess):
+        # texts are hashed exactly as given, the tokenizer is sensitive to
+        # whitespace and unicode form so they cannot be normalized further
+        if not isinstance(text, str):
+            return None
+        digest = hashlib.sha256()
+        digest.update(f"{self.version}\0{int(bool(preprocess))}\0".encode())
+        digest.update(text.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        # stay below the sqlite limit on bound parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT key, value FROM predictions WHERE key IN (%s)"
+                % ','.join('?' * len(batch)),
+                batch
+            ).fetchall()
+            for key, value in rows:
+                found[key] = json.loads(value)
+
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE predictions SET accessed = ? WHERE key = ?",
+                [(now, key) for key in found]
+            )
+            self.conn.commit()
+
+        hits = sum(key in found for key in keys)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO predictions (key, value, accessed) VALUES (?, ?, ?)",
+            [(key, json.dumps(value), now) for key, value in items]
+        )
+        self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM predictions WHERE key IN ("
+                "SELECT key FROM predictions ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of entity embeddings in a local SQLite file.
+
+    Entries are keyed by the embedding model and the normalized entity, and
+    vectors are stored as raw float32 bytes. The least recently used entries
+    are evicted once the cache holds more than max_entries.
+    """
+
+    def __init__(self, path, model_name, max_entries):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, entity TEXT NOT NULL, vector BLOB NOT NULL, "
+            "accessed REAL NOT NULL DEFAULT 0, PRIMARY KEY (model, entity))"
+        )
+        # caches created before eviction have no access times
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")]
+        if 'accessed' not in columns:
+            self.conn.execute(
+                "ALTER TABLE embeddings ADD COLUMN accessed REAL NOT NULL DEFAULT 0"
+            )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)"
+        )
+        self.conn.commit()
+
+    def get_many(self, entities):
+        entities = list(entities)
+        found = {}
+        for start in range(0, len(entities), 500):
+            batch = entities[start:start + 500]
+            rows = self.conn.execute(
+                "SELECT entity, vector FROM embeddings WHERE model = ? AND entity IN (%s)"
+                % ','.join('?' * len(batch)),
+                [self.model_name] + batch
+            ).fetchall()
+            for entity, vector in rows:
+                found[entity] = np.frombuffer(vector, dtype=np.float32)
+
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE embeddings SET accessed = ? WHERE model = ? AND entity = ?",
+                [(now, self.model_name, entity) for entity in found]
+            )
+            self.conn.commit()
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, entity, vector, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (self.model_name, entity, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for entity, vector in items
+            ]
+        )
+        self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN ("
+                "SELECT rowid FROM embeddings ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
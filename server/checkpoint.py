@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import hashlib
+
+from results import read_claims
+
+CHECKPOINT_PREFIX = 'checkpoint_'
+
+
+class Checkpoint:
+    """
+    Claims of the rows a job has already predicted, saved after every chunk
+    so that a job predicting the same rows again resumes where it stopped.
+
+    A checkpoint is named after a digest of its params (input file, column,
+    row range), so a retried job and a resubmission under a new job id find
+    the same checkpoint. Each chunk is written to its own parquet file and
+    a small JSON state records how many rows and chunks are done. The state
+    is replaced atomically after the chunk file is written, so a job
+    interrupted at any point resumes from its last complete chunk.
+
+    Only the job holding the lock of a checkpoint writes to it.
+    """
+
+    def __init__(self, save_dir, params):
+        self.save_dir = save_dir
+        self.params = params
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+        self.name = f"{CHECKPOINT_PREFIX}{digest.hexdigest()[:32]}"
+        self.rows = 0
+        self.chunks = 0
+
+    def state_path(self):
+        return os.path.join(self.save_dir, f"{self.name}.json")
+
+    def chunk_path(self, index):
+        return os.path.join(self.save_dir, f"{self.name}_{index}.parquet")
+
+    def lock_key(self):
+        return f"checkpoint_lock:{self.name}"
+
+    def acquire(self, connection, job_id, ttl):
+        return connection.set(self.lock_key(), job_id, nx=True, ex=ttl)
+
+    def release(self, connection, job_id):
+        if connection.get(self.lock_key()) == job_id.encode():
+            connection.delete(self.lock_key())
+
+    def load(self):
+        # the claims of the chunks already done, in row order
+        try:
+            with open(self.state_path()) as f:
+                state = json.load(f)
+            if state['params'] != self.params:
+                return []
+            claims = [read_claims(self.chunk_path(index)) for index in range(state['chunks'])]
+        except FileNotFoundError:
+            # never written, or removed by the job that finished these rows
+            return []
+
+        self.rows = state['rows']
+        self.chunks = state['chunks']
+        return claims
+
+    def save(self, rows, claims_df):
+        claims_df.reset_index(drop=True).to_parquet(
+            self.chunk_path(self.chunks),
+            index=False
+        )
+        self.rows += rows
+        self.chunks += 1
+
+        path = self.state_path()
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump({'params': self.params, 'rows': self.rows, 'chunks': self.chunks}, f)
+        os.replace(f"{path}.tmp", path)
+
+    def remove(self):
+        for path in [self.state_path()] + [self.chunk_path(index) for index in range(self.chunks)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def remove_expired(save_dir, max_age):
+        # checkpoints of rows nobody asked for again within max_age seconds
+        expired = time.time() - max_age
+        for entry in os.scandir(save_dir):
+            if not entry.name.startswith(CHECKPOINT_PREFIX):
+                continue
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -1,2 +1,58 @@
 NUM_THREADS = 10
 SAVED_MODEL_PATH = "../roberta-model-causal"
+INFERENCE_BATCH_SIZE = 32
+RULE_N_BUDGET = 100000
+RELATION_WORKERS = 4
+CSV_CHUNK_SIZE = 5000
+# optional cap on the number of rows read from an upload, None reads all rows
+MAX_ROWS = None
+# sqlite file caching predictions across jobs, None disables the cache
+PREDICTION_CACHE_PATH = "./prediction_cache.sqlite3"
+PREDICTION_CACHE_MAX_ENTRIES = 1000000
+# distinct texts whose results a job keeps in memory to share them with
+# later chunks, older ones fall back to the prediction cache
+SHARED_RESULTS_MAX_ENTRIES = 100000
+# job progress is reported at most once per interval (seconds) or row count
+PROGRESS_INTERVAL = 1.0
+PROGRESS_ROWS = 1000
+# fork a work horse per job (model shared copy-on-write) or run jobs in the worker process
+WORKER_FORK = True
+# inference backend: 'eager' (fp32 pytorch), 'int8' (dynamic quantization) or 'onnx'
+MODEL_BACKEND = 'eager'
+ONNX_MODEL_PATH = "../roberta-model-causal.onnx"
+# number of normalized entities memoized per process by topic_model.preprocess
+ENTITY_CACHE_SIZE = 200000
+# sentence transformer embedding entities for clustering
+EMBEDDING_MODEL = "distilbert-base-nli-stsb-mean-tokens"
+# sqlite file caching entity embeddings, None disables the cache
+EMBEDDING_CACHE_PATH = "./embedding_cache.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = 300000
+# fitted topic models kept per set of entities, None disables reuse
+TOPIC_MODEL_DIR = "./topic_models"
+# the least recently used topic models are removed above this many bytes
+TOPIC_MODEL_DIR_MAX_BYTES = 5 * 1024 ** 3
+# share of new entities left outside every topic above which an extended
+# graph is clustered from scratch instead of incrementally
+CLUSTER_DRIFT_THRESHOLD = 0.3
+# entities within this cosine distance are collapsed before topic modelling,
+# None disables the collapse
+ENTITY_DEDUP_DISTANCE = 0.1
+ENTITY_DEDUP_NEIGHBORS = 10
+# uploads with more rows are split into shards of this many rows, each
+# predicted by its own job, None disables sharding
+SHARD_ROWS = 50000
+# attempts after the first for a failed shard
+SHARD_RETRIES = 3
+# checkpoints of partly predicted rows that no job resumed within this many
+# seconds are removed
+CHECKPOINT_MAX_AGE = 7 * 24 * 60 * 60
+# unix socket path (or (host, port)) of a shared inference server that runs
+# the model for every job, None runs the model inside each job
+INFERENCE_SERVER_ADDRESS = None
+# shared secret (bytes) between the server and its clients, required since
+# the connections exchange pickled messages
+INFERENCE_SERVER_AUTHKEY = None
+# largest batch the server forms across jobs and how long (seconds) the
+# first request of a batch waits for more
+INFERENCE_SERVER_BATCH_SIZE = 64
+INFERENCE_SERVER_MAX_WAIT = 0.01
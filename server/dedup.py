@@ -0,0 +1,66 @@
+import numpy as np
+
+# below this many entities the neighbours are computed exactly
+EXACT_NEIGHBOURS_MAX = 2048
+
+
+def nearest_neighbours(embeddings, n_neighbors):
+    # cosine distances to the n_neighbors nearest entities of every entity,
+    # the first neighbour of an entity is usually itself
+    n_neighbors = min(n_neighbors, len(embeddings))
+    if len(embeddings) <= EXACT_NEIGHBOURS_MAX:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        unit = embeddings / np.maximum(norms, 1e-12)
+        distances = 1 - unit @ unit.T
+        indices = np.argsort(distances, axis=1)[:, :n_neighbors]
+        return indices, np.take_along_axis(distances, indices, axis=1)
+
+    from pynndescent import NNDescent
+
+    index = NNDescent(embeddings, metric='cosine', n_neighbors=n_neighbors, random_state=42)
+    return index.neighbor_graph
+
+
+def find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def near_duplicate_groups(embeddings, max_distance, n_neighbors):
+    """
+    Group entities whose embeddings lie within max_distance (cosine) of
+    each other, following neighbour links transitively.
+
+    Returns the group of every entity as an index into the entities.
+    """
+    parent = np.arange(len(embeddings))
+    if len(embeddings) < 2:
+        return parent
+
+    indices, distances = nearest_neighbours(embeddings, n_neighbors)
+    rows, cols = np.nonzero(distances <= max_distance)
+    for i, j in zip(rows, indices[rows, cols]):
+        root_i, root_j = find(parent, i), find(parent, j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(parent, i) for i in range(len(parent))])
+
+
+def collapse_entities(entities, embeddings, weights, max_distance, n_neighbors):
+    """
+    Collapse near-duplicate entities onto one canonical entity per group.
+
+    The canonical entity of a group is its heaviest member, ties going to
+    the shortest string. Returns the canonical index of every entity.
+    """
+    groups = near_duplicate_groups(embeddings, max_distance, n_neighbors)
+
+    best = {}
+    for i, group in enumerate(groups):
+        key = (-weights[i], len(entities[i]), entities[i])
+        if group not in best or key < best[group][0]:
+            best[group] = (key, i)
+    return np.array([best[group][1] for group in groups])
@@ -0,0 +1,226 @@
+import os
+import time
+import queue
+import logging
+import argparse
+import threading
+from collections import Counter, deque
+from multiprocessing.connection import Client, Listener
+import numpy as np
+
+from config import (
+    SAVED_MODEL_PATH,
+    NUM_THREADS,
+    MODEL_BACKEND,
+    ONNX_MODEL_PATH,
+    INFERENCE_SERVER_ADDRESS,
+    INFERENCE_SERVER_AUTHKEY,
+    INFERENCE_SERVER_BATCH_SIZE,
+    INFERENCE_SERVER_MAX_WAIT,
+)
+from predictor import Predictor
+
+# number of recent requests the latency percentiles are computed over
+LATENCY_WINDOW = 10000
+
+
+class Request:
+    # the sequences one client sent in a single call
+    def __init__(self, input_ids):
+        self.input_ids = input_ids
+        self.predictions = [None] * len(input_ids)
+        self.remaining = len(input_ids)
+        self.error = None
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+
+
+class DynamicBatcher:
+    """
+    Gathers the sequences of concurrent requests into batches of up to
+    max_batch_size. A batch is run as soon as it is full or max_wait seconds
+    after its first sequence arrived, whichever comes first.
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def submit(self, input_ids):
+        request = Request(input_ids)
+        if not input_ids:
+            return []
+        for i in range(len(input_ids)):
+            self.queue.put((request, i))
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.predictions
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run_batch(items)
+
+    def _run_batch(self, items):
+        input_ids = [request.input_ids[i] for request, i in items]
+        try:
+            predictions = self.predictor._forward_batch(input_ids)
+        except Exception as e:
+            logging.exception("Batch of %d sequences failed", len(items))
+            for request, _ in items:
+                request.error = e
+                request.done.set()
+            return
+
+        self.batch_sizes[len(items)] += 1
+        for row, (request, i) in enumerate(items):
+            request.predictions[i] = predictions[row, :len(input_ids[row])]
+            request.remaining -= 1
+            if request.remaining == 0:
+                self.requests += 1
+                self.latencies.append(time.perf_counter() - request.received)
+                request.done.set()
+
+    def stats(self):
+        latencies = np.array(self.latencies)
+        percentiles = {}
+        if len(latencies):
+            percentiles = {
+                f"p{p}": 1000 * float(np.percentile(latencies, p))
+                for p in (50, 90, 99)
+            }
+        return {
+            'queue_depth': self.queue.qsize(),
+            'requests': self.requests,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'latency_ms': percentiles,
+        }
+
+
+def serve_connection(conn, batcher):
+    # one thread per client, its requests block until their batch has run
+    with conn:
+        while True:
+            try:
+                command, payload = conn.recv()
+            except EOFError:
+                return
+            try:
+                if command == 'tag':
+                    result = batcher.submit(payload)
+                elif command == 'stats':
+                    result = batcher.stats()
+                else:
+                    raise ValueError(f"Unknown command '{command}'")
+                conn.send(('ok', result))
+            except Exception as e:
+                conn.send(('error', repr(e)))
+
+
+def check_authkey(authkey):
+    # connections unpickle what the other side sends, so anyone able to
+    # connect without the key could run code in the server
+    if not isinstance(authkey, bytes) or not authkey:
+        raise ValueError("INFERENCE_SERVER_AUTHKEY must be set to a non-empty bytes key")
+
+
+def serve(address, authkey):
+    from model import ModelRunner
+
+    check_authkey(authkey)
+
+    ModelRunner.load_model(
+        SAVED_MODEL_PATH,
+        NUM_THREADS,
+        backend=MODEL_BACKEND,
+        onnx_path=ONNX_MODEL_PATH
+    )
+    logging.info("Loaded model in %.2fs", ModelRunner.load_time)
+    predictor = Predictor(
+        model=ModelRunner.model,
+        tokenizer=ModelRunner.tokenizer,
+        device=ModelRunner.device
+    )
+    batcher = DynamicBatcher(
+        predictor,
+        INFERENCE_SERVER_BATCH_SIZE,
+        INFERENCE_SERVER_MAX_WAIT
+    )
+    threading.Thread(target=batcher.run, daemon=True).start()
+
+    # a unix socket left behind by an earlier run would block the listener
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)
+    with Listener(address, authkey=authkey) as listener:
+        logging.info("Serving on %s", address)
+        while True:
+            conn = listener.accept()
+            threading.Thread(
+                target=serve_connection,
+                args=(conn, batcher),
+                daemon=True
+            ).start()
+
+
+class RemotePredictor(Predictor):
+    # Predictor whose forward passes run in the shared inference server,
+    # only the tokenizer is loaded in the job itself
+    def __init__(self, tokenizer, address, authkey, cache=None):
+        check_authkey(authkey)
+        super().__init__(model=None, tokenizer=tokenizer, device=None, cache=cache)
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+
+    def _request(self, command, payload=None):
+        if self.conn is None:
+            self.conn = Client(self.address, authkey=self.authkey)
+        self.conn.send((command, payload))
+        status, result = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError(f"Inference server error: {result}")
+        return result
+
+    def _forward_batch(self, input_ids):
+        rows = self._request('tag', [list(ids) for ids in input_ids])
+        predictions = np.zeros((len(rows), max(len(row) for row in rows)), dtype=np.int64)
+        for i, row in enumerate(rows):
+            predictions[i, :len(row)] = row
+        return predictions
+
+    def stats(self):
+        return self._request('stats')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared inference server for the causal claims model")
+    parser.add_argument("--stats", action="store_true", help="print the stats of a running server")
+    args = parser.parse_args()
+
+    if INFERENCE_SERVER_ADDRESS is None:
+        raise SystemExit("INFERENCE_SERVER_ADDRESS is not set in config.py")
+    try:
+        check_authkey(INFERENCE_SERVER_AUTHKEY)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    if args.stats:
+        print(RemotePredictor(None, INFERENCE_SERVER_ADDRESS, INFERENCE_SERVER_AUTHKEY).stats())
+    else:
+        logging.basicConfig(level=logging.INFO)
+        serve(INFERENCE_SERVER_ADDRESS, INFERENCE_SERVER_AUTHKEY)
@@ -1,107 +1,555 @@
 import os
+import time
+from uuid import uuid4
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from rq import get_current_job
+from rq import Queue, Retry, get_current_job
+from rq.job import Job
 
-from config import SAVED_MODEL_PATH, NUM_THREADS
+from config import (
+    SAVED_MODEL_PATH,
+    NUM_THREADS,
+    MODEL_BACKEND,
+    ONNX_MODEL_PATH,
+    INFERENCE_BATCH_SIZE,
+    RELATION_WORKERS,
+    CSV_CHUNK_SIZE,
+    MAX_ROWS,
+    PREDICTION_CACHE_PATH,
+    PREDICTION_CACHE_MAX_ENTRIES,
+    SHARD_ROWS,
+    SHARD_RETRIES,
+    CHECKPOINT_MAX_AGE,
+    SHARED_RESULTS_MAX_ENTRIES,
+    INFERENCE_SERVER_ADDRESS,
+    INFERENCE_SERVER_AUTHKEY,
+)
+from cache import PredictionCache, model_version
+from checkpoint import Checkpoint
+from inference_server import RemotePredictor
 from model import ModelRunner
-from predictor import Predictor
+from predictor import Predictor, RecentResults
+from progress import ProgressReporter, ShardProgress
+from results import (
+    load_claims,
+    load_shard_claims,
+    load_summary,
+    remove_shard_claims,
+    save_results,
+    save_shard_claims,
+)
 from topic_model import create_clustered_graph, create_graph
 
 
+def read_column(file_path, column_name, max_rows=None):
+    # stream only the selected column, CSV_CHUNK_SIZE rows at a time
+    return pd.read_csv(
+        file_path,
+        usecols=[column_name],
+        chunksize=CSV_CHUNK_SIZE,
+        nrows=max_rows,
+    )
+
+
+def read_rows(file_path, column_name, start=0, stop=None):
+    # the column of rows [start, stop) in chunks. the rows before start are
+    # parsed and skipped rather than skipped by line, since quoted fields
+    # may span several lines
+    offset = 0
+    for chunk in read_column(file_path, column_name, stop):
+        if offset + len(chunk) > start:
+            yield chunk.iloc[max(start - offset, 0):]
+        offset += len(chunk)
+
+
+def count_rows(file_path, column_name, max_rows=None):
+    return sum(len(chunk) for chunk in read_column(file_path, column_name, max_rows))
+
+
+def count_input_rows(job, file_path, column_name):
+    # count rows up front so progress has a total, the file itself is
+    # streamed in chunks and never held in memory as a whole
+    total = count_rows(
+        file_path,
+        column_name,
+        None if MAX_ROWS is None else MAX_ROWS + 1
+    )
+    job.meta['truncated'] = False
+    if MAX_ROWS is not None and total > MAX_ROWS:
+        total = MAX_ROWS
+        job.meta['truncated'] = True
+    return total
+
+
+def checkpoint_params(file_path, column_name, preprocess, start, stop):
+    # a checkpoint only applies to the same rows of the same file
+    stat = os.stat(file_path)
+    return {
+        'file': file_path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'column': column_name,
+        'preprocess': preprocess,
+        'start': start,
+        'stop': stop,
+    }
+
+
+@contextmanager
+def claim_checkpoint(job, save_dir, params):
+    """
+    Checkpoint of the rows described by params, locked by this job until the
+    block exits. Yields None without a save_dir, or when another job is
+    predicting the same rows and holds the lock.
+    """
+    if not save_dir:
+        yield None
+        return
+
+    Checkpoint.remove_expired(save_dir, CHECKPOINT_MAX_AGE)
+    checkpoint = Checkpoint(save_dir, params)
+    # the lock outlives a job killed by its timeout for no longer than that
+    ttl = job.timeout if job.timeout and job.timeout > 0 else CHECKPOINT_MAX_AGE
+    if not checkpoint.acquire(job.connection, job.id, ttl):
+        yield None
+        return
+    try:
+        yield checkpoint
+    finally:
+        checkpoint.release(job.connection, job.id)
+
+
+def build_predictor(job):
+    started = time.perf_counter()
+    # Load model, a no-op when the worker preloaded it. with an inference
+    # server the model lives there and only the tokenizer is loaded here
+    if INFERENCE_SERVER_ADDRESS is not None:
+        preloaded = ModelRunner.tokenizer is not None
+        ModelRunner.load_tokenizer(SAVED_MODEL_PATH)
+    else:
+        preloaded = ModelRunner.model is not None
+        ModelRunner.load_model(
+            SAVED_MODEL_PATH,
+            NUM_THREADS,
+            backend=MODEL_BACKEND,
+            onnx_path=ONNX_MODEL_PATH
+        )
+    cache = None
+    if PREDICTION_CACHE_PATH:
+        cache = PredictionCache(
+            PREDICTION_CACHE_PATH,
+            # the backends do not agree on every tag, so each keeps its own entries
+            f"{model_version(SAVED_MODEL_PATH)}-{MODEL_BACKEND}",
+            PREDICTION_CACHE_MAX_ENTRIES
+        )
+    if INFERENCE_SERVER_ADDRESS is not None:
+        predictor = RemotePredictor(
+            tokenizer=ModelRunner.tokenizer,
+            address=INFERENCE_SERVER_ADDRESS,
+            authkey=INFERENCE_SERVER_AUTHKEY,
+            cache=cache
+        )
+    else:
+        predictor = Predictor(
+            model=ModelRunner.model,
+            tokenizer=ModelRunner.tokenizer,
+            device=ModelRunner.device,
+            cache=cache
+        )
+    job.meta['model_preloaded'] = preloaded
+    job.meta['model_load_time'] = ModelRunner.load_time
+    job.meta['startup_time'] = time.perf_counter() - started
+    return predictor
+
+
+def predict_claims(
+        job,
+        predictor,
+        reporter,
+        file_path,
+        column_name,
+        preprocess,
+        start=0,
+        stop=None,
+        checkpoint=None
+    ):
+    # rows already done by an earlier run of the job are skipped
+    claims = []
+    offset = 0
+    if checkpoint is not None:
+        claims = checkpoint.load()
+        offset = checkpoint.rows
+        if offset:
+            job.meta['resumed_rows'] = offset
+            reporter.update(offset)
+
+    # results of the recent distinct texts of the job, shared across chunks
+    seen = RecentResults(SHARED_RESULTS_MAX_ENTRIES)
+
+    def on_progress(progress):
+        if predictor.cache is not None:
+            job.meta['cache_hits'] = predictor.cache.hits
+            job.meta['cache_misses'] = predictor.cache.misses
+        job.meta['timings'] = dict(predictor.timings)
+        job.meta.update(predictor.dedup_stats())
+        reporter.update(offset + progress)
+
+    # relation extraction runs in a process pool next to the model
+    executor = None
+    if RELATION_WORKERS > 0:
+        executor = ProcessPoolExecutor(max_workers=RELATION_WORKERS)
+    try:
+        for chunk in read_rows(file_path, column_name, start + offset, stop):
+            input_text = chunk[column_name].values.tolist()
+            results = predictor.run_prediction_batch(
+                input_text,
+                preprocess,
+                batch_size=INFERENCE_BATCH_SIZE,
+                progress_callback=on_progress,
+                executor=executor,
+                max_pending=2 * RELATION_WORKERS,
+                seen=seen
+            )
+            cause_effect_pairs = [result['pairs'] for result in results]
+
+            chunk_df = pd.DataFrame(
+                zip(input_text, cause_effect_pairs),
+                columns=['text', 'pairs']
+            )
+            # only rows with cause-effect pairs are kept for building the graph
+            chunk_df = chunk_df.loc[chunk_df['pairs'].astype(bool)]
+            if checkpoint is not None:
+                checkpoint.save(len(input_text), chunk_df)
+            claims.append(chunk_df)
+            offset += len(input_text)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    job.meta['timings'] = dict(predictor.timings)
+    job.meta.update(predictor.dedup_stats())
+
+    if claims:
+        return pd.concat(claims, ignore_index=True)
+    return pd.DataFrame(columns=['text', 'pairs'])
+
+
+def build_graph(job, reporter, claims_df, cluster, save_dir, base_graph_id=None):
+    # more rows for an earlier graph extend its claims, and its stored
+    # topic model when clustering
+    base_df = None
+    if base_graph_id is not None:
+        base_df = load_claims(save_dir, base_graph_id)
+        claims_df = pd.concat([base_df, claims_df], ignore_index=True)
+
+    graph_start = time.perf_counter()
+    topics = None
+    if cluster:
+        reporter.set_status('create_clusters')
+        job.meta['clustering'] = {}
+        result_df, topics = create_clustered_graph(
+            claims_df,
+            base_df=base_df,
+            stats=job.meta['clustering']
+        )
+    else:
+        result_df = create_graph(claims_df)
+    job.meta.setdefault('timings', {})['graph'] = time.perf_counter() - graph_start
+    return claims_df, result_df, topics
+
+
 def create_causal_graph(
         file_path,
         column_name,
         progress_callback,
         cluster=False,
         preprocess=False,
-        save_dir=""
+        save_dir="",
+        base_graph_id=None
     ):
     job = get_current_job()
-    # Load model
-    ModelRunner.load_model(SAVED_MODEL_PATH, NUM_THREADS)
-    predictor = Predictor(
-        model=ModelRunner.model,
-        tokenizer=ModelRunner.tokenizer,
-        device=ModelRunner.device
-    )
-
-    # Read uploaded file
-    df = pd.read_csv(file_path)
-    # TODO: limit to first 10000 rows (need to think of a better way)
-    df = df.head(10000)
-    input_text = df[column_name].values.tolist()
+    predictor = build_predictor(job)
+    total = count_input_rows(job, file_path, column_name)
 
     # update job metadata
-    job.meta['status'] = 'cause_effect'
-    job.meta['progress'] = 0
-    job.meta['total'] = len(input_text)
+    reporter = ProgressReporter(job, progress_callback)
+    reporter.start('cause_effect', total)
+
+    params = checkpoint_params(file_path, column_name, preprocess, 0, MAX_ROWS)
+    with claim_checkpoint(job, save_dir, params) as checkpoint:
+        claims_df = predict_claims(
+            job,
+            predictor,
+            reporter,
+            file_path,
+            column_name,
+            preprocess,
+            stop=MAX_ROWS,
+            checkpoint=checkpoint
+        )
+        if save_dir:
+            claims_df.to_csv(os.path.join(save_dir, f"{job.id}_claims.csv"), index=False)
+
+        claims_df, result_df, topics = build_graph(
+            job,
+            reporter,
+            claims_df,
+            cluster,
+            save_dir,
+            base_graph_id
+        )
+
+        summary = finish_graph(
+            job.id,
+            reporter,
+            save_dir,
+            result_df,
+            claims_df,
+            topics,
+            cluster=cluster,
+            truncated=job.meta['truncated'],
+            baseGraphId=base_graph_id,
+        )
+        if checkpoint is not None:
+            checkpoint.remove()
+    return summary
+
+
+def create_sharded_graph(
+        file_path,
+        column_name,
+        progress_callback,
+        cluster=False,
+        preprocess=False,
+        save_dir="",
+        base_graph_id=None
+    ):
+    """
+    Split the rows of an upload into shards of SHARD_ROWS rows predicted by
+    separate jobs, so that several workers share a large upload.
+
+    A merge job waits on the shards and builds the graph once from their
+    claims in row order. Progress and the result are reported under the id
+    of this job, a failed shard is retried on its own.
+    """
+    job = get_current_job()
+    total = count_input_rows(job, file_path, column_name)
+    if SHARD_ROWS is None or total <= SHARD_ROWS:
+        return create_causal_graph(
+            file_path,
+            column_name,
+            progress_callback,
+            cluster=cluster,
+            preprocess=preprocess,
+            save_dir=save_dir,
+            base_graph_id=base_graph_id
+        )
+
+    reporter = ProgressReporter(job, progress_callback)
+    reporter.start('cause_effect', total)
+
+    # shards save their progress into the meta of this job, so the ids of
+    # the shard and merge jobs are stored before any of them can run
+    ranges = [
+        (start, min(start + SHARD_ROWS, total))
+        for start in range(0, total, SHARD_ROWS)
+    ]
+    shard_ids = [str(uuid4()) for _ in ranges]
+    merge_id = str(uuid4())
+    job.meta['shards'] = shard_ids
+    job.meta['merge_job'] = merge_id
     job.save_meta()
-    progress_callback({
-            'status': job.meta['status'],
-            'progress': job.meta['progress'],
-            'total': job.meta['total'],
+
+    queue = Queue(job.origin, connection=job.connection)
+    shard_jobs = []
+    for index, (shard_id, (start, stop)) in enumerate(zip(shard_ids, ranges)):
+        shard_jobs.append(queue.enqueue(
+            predict_shard,
+            args=(
+                job.id,
+                index,
+                file_path,
+                column_name,
+                start,
+                stop,
+                ShardProgress(job.id, total, progress_callback),
+            ),
+            kwargs={
+                'preprocess': preprocess,
+                'save_dir': save_dir,
+            },
+            retry=Retry(max=SHARD_RETRIES),
+            job_timeout='30m',
+            job_id=shard_id,
+        ))
+
+    queue.enqueue(
+        merge_shards,
+        args=(
+            job.id,
+            len(shard_jobs),
+            progress_callback,
+        ),
+        kwargs={
+            'cluster': cluster,
+            'save_dir': save_dir,
+            'base_graph_id': base_graph_id,
+            'truncated': job.meta['truncated'],
         },
-        job,
+        depends_on=shard_jobs,
+        job_timeout='30m',
+        job_id=merge_id,
     )
 
-    cause_effect_pairs = []
-    for i, text in enumerate(input_text):
-        result = predictor.run_prediction(text, preprocess)
-        cause_effect_pairs.append(result['pairs'])
-
-        job.meta['progress'] = i+1
-        job.save_meta()
-        progress_callback({
-                'status': job.meta['status'],
-                'progress': job.meta['progress'],
-                'total': job.meta['total'],
-            },
+    return {'jobId': job.id, 'shards': len(shard_jobs)}
+
+
+def predict_shard(
+        parent_id,
+        index,
+        file_path,
+        column_name,
+        start,
+        stop,
+        progress_callback,
+        preprocess=False,
+        save_dir=""
+    ):
+    # predict rows [start, stop) of a sharded job and store their claims
+    job = get_current_job()
+    predictor = build_predictor(job)
+
+    reporter = ProgressReporter(job, progress_callback)
+    reporter.start('cause_effect', stop - start)
+    params = checkpoint_params(file_path, column_name, preprocess, start, stop)
+    with claim_checkpoint(job, save_dir, params) as checkpoint:
+        claims_df = predict_claims(
             job,
+            predictor,
+            reporter,
+            file_path,
+            column_name,
+            preprocess,
+            start=start,
+            stop=stop,
+            checkpoint=checkpoint
         )
-    
-    claims_df = pd.DataFrame(
-        zip(input_text, cause_effect_pairs),
-        columns=['text', 'pairs']
+        save_shard_claims(save_dir, parent_id, index, claims_df)
+        if checkpoint is not None:
+            checkpoint.remove()
+    job.save_meta()
+    return len(claims_df)
+
+
+def merge_shards(
+        parent_id,
+        shards,
+        progress_callback,
+        cluster=False,
+        save_dir="",
+        base_graph_id=None,
+        truncated=False
+    ):
+    # build the graph of a sharded job once all of its shards are predicted
+    job = get_current_job()
+    parent = Job.fetch(parent_id, connection=job.connection)
+    reporter = ProgressReporter(parent, progress_callback)
+
+    claims_df = pd.concat(
+        [load_shard_claims(save_dir, parent_id, index) for index in range(shards)],
+        ignore_index=True
     )
+    if save_dir:
+        claims_df.to_csv(os.path.join(save_dir, f"{parent_id}_claims.csv"), index=False)
 
-    claims_df = claims_df.loc[claims_df['pairs'].astype(bool)]
-    del df
+    claims_df, result_df, topics = build_graph(
+        parent,
+        reporter,
+        claims_df,
+        cluster,
+        save_dir,
+        base_graph_id
+    )
+    summary = finish_graph(
+        parent_id,
+        reporter,
+        save_dir,
+        result_df,
+        claims_df,
+        topics,
+        cluster=cluster,
+        truncated=truncated,
+        baseGraphId=base_graph_id,
+    )
+    remove_shard_claims(save_dir, parent_id, shards)
+    job.connection.delete(ShardProgress.key(parent_id))
+    return summary
 
-    topics = None
-    if cluster:
-        job.meta['status'] = 'create_clusters'
-        job.save_meta()
-        progress_callback({
-                'status': job.meta['status'],
-                'progress': job.meta['progress'],
-                'total': job.meta['total'],
-            },
-            job,
-        )
-        result_df, topics = create_clustered_graph(claims_df)
-    else:
-        result_df = create_graph(claims_df)
 
+def cluster_graph(
+        graph_id,
+        progress_callback,
+        nr_topics='auto',
+        n_gram_range=(1, 2),
+        top_n_words=10,
+        save_dir=""
+    ):
+    # re-cluster the stored claims of an earlier job
+    job = get_current_job()
+    job.meta['graph_id'] = graph_id
+    reporter = ProgressReporter(job, progress_callback)
+    reporter.start('load_claims', 1)
+    claims_df = load_claims(save_dir, graph_id)
+    graph_summary = load_summary(save_dir, graph_id) or {}
+
+    reporter.set_status('create_clusters')
+    graph_start = time.perf_counter()
+    result_df, topics = create_clustered_graph(
+        claims_df,
+        nr_topics=nr_topics,
+        n_gram_range=n_gram_range,
+        top_n_words=top_n_words,
+    )
+    job.meta['timings'] = {'graph': time.perf_counter() - graph_start}
+    job.meta['progress'] = 1
+
+    return finish_graph(
+        job.id,
+        reporter,
+        save_dir,
+        result_df,
+        claims_df,
+        topics,
+        graphId=graph_id,
+        cluster=True,
+        truncated=graph_summary.get('truncated', False),
+    )
+
+
+def finish_graph(job_id, reporter, save_dir, result_df, claims_df, topics, **summary):
     # save file to download directory
     if save_dir:
-        result_df.to_csv(os.path.join(save_dir, f"{job.id}.csv"), index=False)
-    
+        result_df.to_csv(os.path.join(save_dir, f"{job_id}.csv"), index=False)
+
     # drop rows with -1 cluster
     result_df = result_df[result_df["cause_cluster"] != -1]
     result_df = result_df[result_df["effect_cluster"] != -1]
 
-    job.meta['status'] = 'finished'
-    job.save_meta()
-    progress_callback({
-            'status': job.meta['status'],
-            'progress': job.meta['progress'],
-            'total': job.meta['total'],
-            'result_df': result_df.to_json(orient="records"),
-            'claims_df': claims_df.to_json(orient="records"),
-            'topics': topics,
-            'cluster': cluster,
-        },
-        job,
-    )
+    # the graph is stored once and fetched in slices through the api,
+    # the socket only announces that it is ready
+    if save_dir:
+        summary = save_results(
+            save_dir,
+            job_id,
+            result_df,
+            claims_df,
+            topics,
+            **summary
+        )
+    else:
+        summary = {'jobId': job_id, **summary}
+
+    reporter.set_status('finished', **summary)
 
-    return result_df, claims_df, topics
+    return summary
@@ -1,3 +1,5 @@
+import os
+import time
 import torch
 import torch.nn as nn
 from transformers import RobertaConfig
@@ -57,20 +59,118 @@ class RobertaForTokenClassification(RobertaPreTrainedModel):
         )
 
 
+class LogitsOnly(nn.Module):
+    # plain tensor output for tracing the model into an onnx graph
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids, attention_mask=attention_mask).logits
+
+
+class OnnxTokenClassifier:
+    # runs the exported model through onnx runtime behind the same call
+    # signature as RobertaForTokenClassification
+    def __init__(self, onnx_path, num_threads):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            onnx_path,
+            options,
+            providers=['CPUExecutionProvider']
+        )
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask=None, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        logits = self.session.run(['logits'], {
+            'input_ids': input_ids.cpu().numpy(),
+            'attention_mask': attention_mask.cpu().numpy(),
+        })[0]
+        return (torch.from_numpy(logits),)
+
+
+def export_onnx(model, onnx_path):
+    model.eval()
+    dummy = torch.ones((1, 8), dtype=torch.long)
+    # exported under a name of its own and moved into place once complete,
+    # so that workers starting together never load a half-written file
+    tmp_path = f"{onnx_path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        LogitsOnly(model).cpu(),
+        (dummy, dummy),
+        tmp_path,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['logits'],
+        dynamic_axes={
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            'logits': {0: 'batch', 1: 'sequence'},
+        },
+        opset_version=12,
+    )
+    os.replace(tmp_path, onnx_path)
+
+
+def load_backend(model, backend, num_threads, onnx_path=None):
+    """
+    Wrap a loaded RobertaForTokenClassification in an inference backend:
+        eager: fp32 pytorch model as is
+        int8: linear layers dynamically quantized to int8 (cpu only)
+        onnx: graph exported to onnx_path and run through onnx runtime (cpu only)
+    """
+    if backend == 'eager':
+        return model
+    if backend == 'int8':
+        return torch.quantization.quantize_dynamic(
+            model.cpu(),
+            {nn.Linear},
+            dtype=torch.qint8
+        )
+    if backend == 'onnx':
+        if not os.path.exists(onnx_path):
+            export_onnx(model, onnx_path)
+        return OnnxTokenClassifier(onnx_path, num_threads)
+    raise ValueError(f"Unknown model backend '{backend}'")
+
+
 class ModelRunner:
     model = None
     tokenizer = None
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    load_time = None
 
     @classmethod
-    def load_model(cls, SAVED_MODEL_PATH, NUM_THREADS):
+    def load_model(cls, SAVED_MODEL_PATH, NUM_THREADS, backend='eager', onnx_path=None):
         if cls.model is None:
-            if cls.device == 'cpu':
+            start = time.perf_counter()
+            # the quantized and onnx backends only run on cpu
+            if backend != 'eager':
+                cls.device = torch.device("cpu")
+            if cls.device.type == 'cpu':
                 torch.set_num_threads(NUM_THREADS)
+            cls.load_tokenizer(SAVED_MODEL_PATH)
+            if backend == 'onnx' and os.path.exists(onnx_path):
+                # the pytorch model is only needed to export the graph
+                cls.model = OnnxTokenClassifier(onnx_path, NUM_THREADS)
+            else:
+                model = (RobertaForTokenClassification
+                         .from_pretrained(SAVED_MODEL_PATH)
+                         .to(cls.device))
+                cls.model = load_backend(model, backend, NUM_THREADS, onnx_path)
+            cls.load_time = time.perf_counter() - start
+
+    @classmethod
+    def load_tokenizer(cls, SAVED_MODEL_PATH):
+        # enough on its own when the model runs in the inference server
+        if cls.tokenizer is None:
             cls.tokenizer = AutoTokenizer.from_pretrained(
                 SAVED_MODEL_PATH,
                 add_prefix_space=True
             )
-            cls.model = (RobertaForTokenClassification
-                        .from_pretrained(SAVED_MODEL_PATH)
-                        .to(cls.device))
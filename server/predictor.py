@@ -1,138 +1,270 @@
+import time
+import hashlib
 import torch
+import numpy as np
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
 import pandas as pd
 from nltk.tokenize import sent_tokenize
 from cleantext import clean
-from langdetect import detect
+from langdetect import DetectorFactory, detect
 from langdetect.lang_detect_exception import LangDetectException
 
-from topic_model import create_clustered_graph, create_graph
 from relation_identification import final_result
 
+# langdetect samples at random unless seeded, the seed is set on import so
+# that every process of the pool detects the same language for a text
+DetectorFactory.seed = 0
+
+
+def preprocess_text(text):
+    return clean(
+        text,
+        fix_unicode=True,           # fix various unicode errors
+        to_ascii=True,              # transliterate to closest ASCII representation
+        lower=False,                # lowercase text
+        no_line_breaks=True,        # fully strip line breaks as opposed to only normalizing them
+        no_urls=True,               # replace all URLs with a special token
+        no_emails=True,             # replace all email addresses with a special token
+        no_phone_numbers=False,     # replace all phone numbers with a special token
+        no_numbers=False,           # replace all numbers with a special token
+        no_digits=False,            # replace all digits with a special token
+        no_currency_symbols=False,  # replace all currency symbols with a special token
+        no_punct=False,             # remove punctuations
+        no_emoji=True,              # remove emoji
+        replace_with_punct="",      # instead of removing punctuations you may replace them
+        replace_with_url="<URL>",
+        replace_with_email="<EMAIL>",
+        replace_with_phone_number="<PHONE>",
+        replace_with_number="<NUMBER>",
+        replace_with_digit="0",
+        replace_with_currency_symbol="<CUR>",
+        lang="en",
+    )
+
+
+def prepare_text(text, preprocess):
+    if preprocess:
+        text = preprocess_text(text)
+
+    if not text or pd.isna(text):
+        return text, ''
+
+    try:
+        language = detect(text)
+    except LangDetectException:
+        language = ''
+        # logging.warning(f"Language detection failed. Input text: {text}")
+
+    return text, language
+
+
+def prepare_batch(texts, preprocess):
+    # module level so that batches can be prepared in a process pool
+    return [prepare_text(text, preprocess) for text in texts]
+
+
+def text_digest(text):
+    # compact key of a text for sharing results between identical rows
+    if not isinstance(text, str):
+        return text
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class RecentResults:
+    # the results of the max_entries most recently seen texts, by digest
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+
+    def get(self, key):
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+        return result
+
+    def set_many(self, items):
+        for key, result in items:
+            self.results[key] = result
+            self.results.move_to_end(key)
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+
+
+def align_word_tags(encodings, predictions):
+    # map the subword predictions of a batch back to words: every word keeps
+    # the tag of its first subword and its subword strings are concatenated.
+    # special tokens and padding have no word id and are marked with -1
+    word_ids = np.full(predictions.shape, -1)
+    for row, (_, _, ids) in enumerate(encodings):
+        word_ids[row, :len(ids)] = [-1 if idx is None else idx for idx in ids]
+
+    previous = np.full_like(word_ids, -1)
+    previous[:, 1:] = word_ids[:, :-1]
+    starts = word_ids != previous
+
+    aligned = []
+    for row, (_, tokens, _) in enumerate(encodings):
+        positions = np.flatnonzero(starts[row])
+        ends = np.append(positions[1:], len(tokens))
+        words = []
+        for start, end in zip(positions, ends):
+            word = tokens[start].replace('Ġ', '')
+            if word_ids[row, start] >= 0:
+                word += ''.join(tokens[start + 1:end])
+            words.append(word)
+        aligned.append((words, predictions[row, positions]))
+
+    return aligned
+
+
+def extract_pairs(tokens, tags):
+    pairs = final_result(tags, tokens)
+    cause_effect = []
+
+    if pairs == 0:
+        return []
+
+    for pair in pairs:
+        cause = pair[0]
+        effect = pair[1]
+
+        cause_str = " ".join(map(lambda i: tokens[i], cause))
+        effect_str = " ".join(map(lambda i: tokens[i], effect))
+        cause_effect.append([cause_str, effect_str])
+
+    return cause_effect
+
+
+def extract_batch_pairs(tagged):
+    # module level so that it can run in a process pool
+    return [extract_pairs(tokens, tags) for tokens, tags in tagged]
+
 
 class Predictor:
-    def __init__(self, model, tokenizer, device):
+    def __init__(self, model, tokenizer, device, cache=None):
         # initialize model and tokenizer
         self.device = device
         self.tokenizer = tokenizer
         self.model = model
-        self.model.eval()
+        if self.model is not None:
+            self.model.eval()
+        # optional PredictionCache consulted before the model runs
+        self.cache = cache
 
         self.tags = ["O", "B-C", "I-C", "B-E", "I-E", "B-CE", "I-CE"]
         self.index2tag = {idx: tag for idx, tag in enumerate(self.tags)}
         self.tag2index = {tag: idx for idx, tag in enumerate(self.tags)}
 
-    def _tag_text(self, text):
-        # Get tokens from tokenizer
-        tokens = self.tokenizer(text, truncation=True).tokens()
-        # tokens = list(map(lambda x: x.replace('Ġ', ' '), tokens))
+        # seconds spent in each stage of run_prediction_batch, accumulated
+        # over all calls. with a pool, relations only counts the time spent
+        # waiting on it
+        self.timings = defaultdict(float)
+        # rows passed to run_prediction_batch, rows that duplicated another
+        # row of their batch and texts actually predicted, over all calls
+        self.dedup = Counter()
 
-        word_ids = self.tokenizer(text, truncation=True).word_ids()
-        # Encode the sequence into IDs
-        input_ids = self.tokenizer(
-            text,
-            truncation=True,
-            return_tensors="pt"
-        ).input_ids.to(self.device)
+    @contextmanager
+    def _timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    def _encode(self, texts, truncation=False):
+        # tokenize once and keep ids, tokens and word ids together so that
+        # length routing, tagging and word alignment share one encoding
+        encoding = self.tokenizer(texts, truncation=truncation)
+        return [
+            (
+                encoding['input_ids'][i],
+                encoding.tokens(i),
+                encoding.word_ids(i),
+            )
+            for i in range(len(texts))
+        ]
 
+    def _tag_encoding(self, encoded):
         # Get predictions as distribution over 7 possible classes
-        with torch.no_grad():
-            outputs = self.model(input_ids)[0]
-
-        # Take argmax to get most likely class per token
-        predictions = torch.argmax(outputs, dim=2)
-
-        # Convert to DataFrame
-        preds = [self.index2tag[p] for p in predictions[0].cpu().numpy()]
-
-        # convert to original length
-        original = []
-        original_pred = []
-        previous_word_idx = None
-        for i, word_idx in enumerate(word_ids):
-            if word_idx == previous_word_idx:
-                if previous_word_idx is not None:
-                    original[previous_word_idx] += tokens[i]
-            else:
-                original.append(tokens[i].replace('Ġ', ''))
-                original_pred.append(preds[i])
-            previous_word_idx = word_idx
+        # and take argmax to get most likely class per token
+        predictions = self._forward_batch([encoded[0]])
+        return align_word_tags([encoded], predictions)[0]
 
-        return pd.DataFrame(
-            [original, original_pred],
-            index=["Tokens", "Tags"]
+    def _forward_batch(self, input_ids):
+        # pad the batch to its longest sequence and mask out the padding
+        max_length = max(len(ids) for ids in input_ids)
+        batch = torch.full(
+            (len(input_ids), max_length),
+            self.tokenizer.pad_token_id,
+            dtype=torch.long
         )
+        attention_mask = torch.zeros_like(batch)
+        for i, ids in enumerate(input_ids):
+            batch[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
 
-    def _get_cause_effect_pairs(self, text):
-        result = self._tag_text(text)
-        tokens = result.iloc[0].tolist()
-        pred = result.iloc[1].tolist()
-
-        pairs = final_result([self.tag2index[p] for p in pred], tokens)
-        cause_effect = []
-
-        if pairs == 0:
-            return []
-
-        for pair in pairs:
-            cause = pair[0]
-            effect = pair[1]
-
-            cause_str = " ".join(map(lambda i: tokens[i], cause))
-            effect_str = " ".join(map(lambda i: tokens[i], effect))
-            cause_effect.append([cause_str, effect_str])
-
-        return cause_effect
-
-    def _get_cause_effect_pairs_long(self, text):
-        cause_effect = []
-        for sentence in sent_tokenize(text):
-            sentence = str(sentence)
-            result = self._get_cause_effect_pairs(sentence)
-            cause_effect += result
-
-        return cause_effect
-
-    def _preprocess_text(self, text):
-        return clean(
-            text,
-            fix_unicode=True,           # fix various unicode errors
-            to_ascii=True,              # transliterate to closest ASCII representation
-            lower=False,                # lowercase text
-            no_line_breaks=True,        # fully strip line breaks as opposed to only normalizing them
-            no_urls=True,               # replace all URLs with a special token
-            no_emails=True,             # replace all email addresses with a special token
-            no_phone_numbers=False,     # replace all phone numbers with a special token
-            no_numbers=False,           # replace all numbers with a special token
-            no_digits=False,            # replace all digits with a special token
-            no_currency_symbols=False,  # replace all currency symbols with a special token
-            no_punct=False,             # remove punctuations
-            no_emoji=True,              # remove emoji
-            replace_with_punct="",      # instead of removing punctuations you may replace them
-            replace_with_url="<URL>",
-            replace_with_email="<EMAIL>",
-            replace_with_phone_number="<PHONE>",
-            replace_with_number="<NUMBER>",
-            replace_with_digit="0",
-            replace_with_currency_symbol="<CUR>",
-            lang="en",
-        )
+        with torch.no_grad():
+            outputs = self.model(
+                batch.to(self.device),
+                attention_mask=attention_mask.to(self.device)
+            )[0]
 
-    def run_prediction(self, text, preprocess):
-        if preprocess:
-            text = self._preprocess_text(text)
+        return torch.argmax(outputs, dim=2).cpu().numpy()
 
-        if not text or pd.isna(text):
-            return {
-                'pairs': [],
-                'language': '',
-            }
+    def _tag_batch(self, encodings, batch_size):
+        # group texts of similar length so each batch carries little padding
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i][0]))
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            batch = [encodings[i] for i in indices]
+            with self._timed('inference'):
+                predictions = self._forward_batch([encoded[0] for encoded in batch])
+                tagged = align_word_tags(batch, predictions)
+            yield indices, tagged
 
-        try:
-            language = detect(text)
-        except LangDetectException:
-            language = ''
-            # logging.warning(f"Language detection failed. Input text: {text}")
+    def _pairs_from_tags(self, tokens, tags):
+        return extract_pairs(tokens, tags)
+
+    def _split_sentences(self, texts):
+        # sentences are encoded in one call rather than sliced out of the
+        # document encoding, since a standalone sentence gets its own prefix
+        # space and would not always tokenize like the in-document slice.
+        # returns the sentence encodings of every text in document order
+        # and the (start, end) range of each text among them
+        sentences = []
+        spans = []
+        for text in texts:
+            start = len(sentences)
+            sentences += [str(sentence) for sentence in sent_tokenize(text)]
+            spans.append((start, len(sentences)))
+        encodings = self._encode(sentences, truncation=True) if sentences else []
+        return encodings, spans
 
+    def _get_cause_effect_pairs_long(self, text, batch_size=32):
+        encodings, _ = self._split_sentences([text])
+        sentence_pairs = [None] * len(encodings)
+        for indices, tagged in self._tag_batch(encodings, batch_size):
+            for i, pairs in zip(indices, extract_batch_pairs(tagged)):
+                sentence_pairs[i] = pairs
+
+        return [pair for pairs in sentence_pairs for pair in pairs]
+
+    def run_prediction(self, text, preprocess):
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(text, preprocess)
+            cached = self.cache.get_many([key] if key is not None else [])
+            if key in cached:
+                return cached[key]
+
+        result = self._predict(text, preprocess)
+        if key is not None:
+            self.cache.set_many([(key, result)])
+        return result
+
+    def _predict(self, text, preprocess):
+        text, language = prepare_text(text, preprocess)
         if language != 'en':
             return {
                 'pairs': [],
@@ -141,36 +273,283 @@ class Predictor:
 
         # if the number of tokens is greater than 256
         # then split the text into sentences and run the model
-        tokens = self.tokenizer(text).tokens()
-        if len(tokens) > 256:
+        encoded = self._encode([text])[0]
+        if len(encoded[0]) > 256:
             result = self._get_cause_effect_pairs_long(text)
         else:
-            result = self._get_cause_effect_pairs(text)
+            result = self._pairs_from_tags(*self._tag_encoding(encoded))
 
         return {
             'pairs': result,
             'language': language,
         }
 
-    def run_prediction_batch(self, text_batch, preprocess, cluster):
-        pairs = []
-        for text in text_batch:
-            result = self.run_prediction(
-                text,
+    def dedup_stats(self):
+        rows = self.dedup['rows']
+        duplicates = self.dedup['duplicates']
+        # duplicates are credited with the average time of a predicted text
+        compute = sum(
+            self.timings[stage]
+            for stage in ('preprocess', 'tokenize', 'inference', 'relations')
+        )
+        per_text = compute / self.dedup['predicted'] if self.dedup['predicted'] else 0
+        return {
+            'duplicates': duplicates,
+            'duplicate_ratio': duplicates / rows if rows else 0,
+            'dedup_saved_seconds': duplicates * per_text,
+        }
+
+    def run_prediction_batch(
+            self,
+            text_batch,
+            preprocess,
+            batch_size=32,
+            progress_callback=None,
+            executor=None,
+            max_pending=2,
+            seen=None
+        ):
+        # identical texts, such as retweets or boilerplate answers, are
+        # predicted once and their result is shared by all of their rows.
+        # seen is an optional RecentResults of texts predicted by earlier
+        # calls, so that a job passing the same one shares them across chunks
+        keys = [text_digest(text) for text in text_batch]
+        known = {}
+        unique = {}
+        for key, text in zip(keys, text_batch):
+            if key in known or key in unique:
+                continue
+            result = seen.get(key) if seen is not None else None
+            if result is not None:
+                known[key] = result
+            else:
+                unique[key] = text
+        self.dedup['rows'] += len(text_batch)
+        self.dedup['duplicates'] += len(text_batch) - len(unique)
+
+        on_progress = None
+        if progress_callback is not None:
+            if not unique and text_batch:
+                progress_callback(len(text_batch))
+
+            # progress is counted in unique texts and reported in rows
+            def on_progress(progress):
+                progress_callback(progress * len(text_batch) // len(unique))
+
+        results = self._run_cached(
+            list(unique.values()),
+            preprocess,
+            batch_size,
+            on_progress,
+            executor,
+            max_pending
+        )
+        known.update(zip(unique, results))
+        if seen is not None:
+            seen.set_many(zip(unique, results))
+        return [known[key] for key in keys]
+
+    def _run_cached(
+            self,
+            text_batch,
+            preprocess,
+            batch_size,
+            progress_callback,
+            executor,
+            max_pending
+        ):
+        if self.cache is None:
+            return self._predict_batch(
+                text_batch,
                 preprocess,
+                batch_size,
+                progress_callback,
+                executor,
+                max_pending
             )
-            pairs.append(result['pairs'])
 
-        claims_df = pd.DataFrame(
-            zip(text_batch, pairs),
-            columns=['text', 'pairs']
+        # cache hits skip preprocessing, language detection and the model
+        with self._timed('cache'):
+            keys = [self.cache.key(text, preprocess) for text in text_batch]
+            cached = self.cache.get_many(key for key in keys if key is not None)
+        misses = [i for i, key in enumerate(keys) if key not in cached]
+        hits = len(text_batch) - len(misses)
+
+        on_progress = None
+        if progress_callback is not None:
+            if hits:
+                progress_callback(hits)
+
+            def on_progress(progress):
+                progress_callback(hits + progress)
+
+        predicted = self._predict_batch(
+            [text_batch[i] for i in misses],
+            preprocess,
+            batch_size,
+            on_progress,
+            executor,
+            max_pending
         )
+        with self._timed('cache'):
+            self.cache.set_many(
+                (keys[i], result)
+                for i, result in zip(misses, predicted)
+                if keys[i] is not None
+            )
 
-        topics = None
-        if cluster:
-            result_df, topics = create_clustered_graph(claims_df)
-        else:
-            result_df = create_graph(claims_df)
+        results = [cached.get(key) for key in keys]
+        for i, result in zip(misses, predicted):
+            results[i] = result
+        return results
+
+    def _predict_batch(
+            self,
+            text_batch,
+            preprocess,
+            batch_size,
+            progress_callback,
+            executor,
+            max_pending
+        ):
+        results = [None] * len(text_batch)
+        progress = 0
+
+        def advance(count):
+            nonlocal progress
+            progress += count
+            if progress_callback is not None:
+                progress_callback(progress)
+
+        # cleaning and language detection run in the pool batch by batch.
+        # non-english and empty rows are dropped before the tokenizer
+        with self._timed('preprocess'):
+            if executor is None:
+                prepared = prepare_batch(text_batch, preprocess)
+            else:
+                batches = [
+                    text_batch[start:start + batch_size]
+                    for start in range(0, len(text_batch), batch_size)
+                ]
+                prepared = [
+                    item
+                    for batch in executor.map(prepare_batch, batches, [preprocess] * len(batches))
+                    for item in batch
+                ]
+
+        english_idx = []
+        english_text = []
+        # texts that only become identical once preprocessed are tagged once
+        # as well, the copies of a text get its result when it finishes
+        first = {}
+        copies = defaultdict(list)
+        for i, (text, language) in enumerate(prepared):
+            if language != 'en':
+                results[i] = {
+                    'pairs': [],
+                    'language': language,
+                }
+                continue
+            if text in first:
+                copies[first[text]].append(i)
+                continue
+
+            first[text] = i
+            english_idx.append(i)
+            english_text.append(text)
+
+        skipped = sum(len(rows) for rows in copies.values())
+        self.dedup['duplicates'] += skipped
+        self.dedup['predicted'] += len(text_batch) - skipped
+        if len(english_text) + skipped < len(text_batch):
+            advance(len(text_batch) - len(english_text) - skipped)
+
+        with self._timed('tokenize'):
+            if english_text:
+                encodings = self._encode(english_text)
+            else:
+                encodings = []
+
+        # every short text is one work unit, long texts are split into one
+        # unit per sentence up front so that all units share the batches
+        long_idx = [
+            k for k, encoded in enumerate(encodings)
+            if len(encoded[0]) > 256
+        ]
+        with self._timed('tokenize'):
+            sentence_encodings, sentence_spans = self._split_sentences(
+                [english_text[k] for k in long_idx]
+            )
+        long_spans = dict(zip(long_idx, sentence_spans))
+
+        unit_rows = []
+        unit_encodings = []
+        row_spans = {}
+        for k, (i, encoded) in enumerate(zip(english_idx, encodings)):
+            start = len(unit_encodings)
+            if k in long_spans:
+                sentence_start, sentence_end = long_spans[k]
+                unit_encodings += sentence_encodings[sentence_start:sentence_end]
+            else:
+                unit_encodings.append(encoded)
+            unit_rows += [i] * (len(unit_encodings) - start)
+            row_spans[i] = (start, len(unit_encodings))
+
+        unit_pairs = [None] * len(unit_encodings)
+        remaining = Counter(unit_rows)
+
+        def finish(i):
+            # returns the number of rows completed
+            start, end = row_spans[i]
+            results[i] = {
+                'pairs': [pair for pairs in unit_pairs[start:end] for pair in pairs],
+                'language': 'en',
+            }
+            for copy in copies[i]:
+                results[copy] = results[i]
+            return 1 + len(copies[i])
+
+        # a long text without any sentence has nothing to tag
+        empty = [i for i in english_idx if i not in remaining]
+        finished = sum(finish(i) for i in empty)
+        if finished:
+            advance(finished)
+
+        def collect(indices, pairs):
+            # a text is complete once the last of its units comes back, its
+            # pairs are then joined in sentence order
+            finished = 0
+            for u, unit in zip(indices, pairs):
+                unit_pairs[u] = unit
+                i = unit_rows[u]
+                remaining[i] -= 1
+                if remaining[i] == 0:
+                    finished += finish(i)
+            if finished:
+                advance(finished)
+
+        # batch the units by length, one forward pass per batch.
+        # with an executor, relations of a batch are extracted in the pool
+        # while the model already tags the next batch
+        pending = deque()
+        for indices, tagged in self._tag_batch(unit_encodings, batch_size):
+            if executor is None:
+                with self._timed('relations'):
+                    pairs = extract_batch_pairs(tagged)
+                collect(indices, pairs)
+                continue
+
+            pending.append((indices, executor.submit(extract_batch_pairs, tagged)))
+            while pending and (pending[0][1].done() or len(pending) > max_pending):
+                indices, future = pending.popleft()
+                with self._timed('relations'):
+                    pairs = future.result()
+                collect(indices, pairs)
+
+        while pending:
+            indices, future = pending.popleft()
+            with self._timed('relations'):
+                pairs = future.result()
+            collect(indices, pairs)
 
-        del claims_df
-        return result_df, topics
+        return results
@@ -0,0 +1,83 @@
+import time
+from rq.job import Job
+
+from config import PROGRESS_INTERVAL, PROGRESS_ROWS
+
+
+class ProgressReporter:
+    # coalesces the progress updates of a job: the job metadata is saved and
+    # the update is sent to the client at most once per PROGRESS_INTERVAL
+    # seconds or every PROGRESS_ROWS rows, while the first update, every
+    # status change and the last update are always sent
+    def __init__(self, job, progress_callback, interval=PROGRESS_INTERVAL, rows=PROGRESS_ROWS):
+        self.job = job
+        self.progress_callback = progress_callback
+        self.interval = interval
+        self.rows = rows
+        self.last_time = None
+        self.last_progress = None
+
+    def start(self, status, total):
+        self.job.meta['status'] = status
+        self.job.meta['progress'] = 0
+        self.job.meta['total'] = total
+        self.flush()
+
+    def set_status(self, status, **data):
+        self.job.meta['status'] = status
+        self.flush(**data)
+
+    def update(self, progress):
+        self.job.meta['progress'] = progress
+        if progress == self.last_progress:
+            return
+        if progress >= self.job.meta['total']:
+            self.flush()
+        elif time.monotonic() - self.last_time >= self.interval:
+            self.flush()
+        elif progress - self.last_progress >= self.rows:
+            self.flush()
+
+    def flush(self, **data):
+        self.job.save_meta()
+        self.progress_callback({
+                'status': self.job.meta['status'],
+                'progress': self.job.meta['progress'],
+                'total': self.job.meta['total'],
+                **data,
+            },
+            self.job,
+        )
+        self.last_time = time.monotonic()
+        self.last_progress = self.job.meta['progress']
+
+
+class ShardProgress:
+    # progress callback of the shards of a sharded job: the progress of each
+    # shard is kept in a redis hash and the sum over all shards is reported
+    # under the parent job, so the client follows a single job
+    def __init__(self, parent_id, total, progress_callback):
+        self.parent_id = parent_id
+        self.total = total
+        self.progress_callback = progress_callback
+
+    @staticmethod
+    def key(parent_id):
+        return f"shard_progress:{parent_id}"
+
+    def __call__(self, data, job):
+        key = self.key(self.parent_id)
+        # a retried shard keeps its job id and resumes from its checkpoint
+        job.connection.hset(key, job.id, data['progress'])
+        progress = sum(int(value) for value in job.connection.hvals(key))
+
+        parent = Job.fetch(self.parent_id, connection=job.connection)
+        parent.meta['progress'] = progress
+        parent.save_meta()
+        self.progress_callback({
+                'status': data['status'],
+                'progress': progress,
+                'total': self.total,
+            },
+            parent,
+        )
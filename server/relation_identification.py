@@ -5,27 +5,72 @@ Author: Zhaoning Li
 '''
 
 import numpy as np
-from itertools import combinations
-import re
+
+from config import RULE_N_BUDGET
+
+
+def find_runs(mask):
+    """
+    Start and end (exclusive) of every run of True in a boolean array
+    """
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
 
 
 def find_idx(ls):
     """
     Find index of causality
     """
-    r = []
-    element = set(ls)
-    if 1 in element:
-        for i in re.finditer('1+', ''.join([str(i) for i in [i if i != 2 else 1 for i in ls]])):
-            r.append([i for i in range(i.start(), i.end())])
-    if 3 in element:
-        for i in re.finditer('3+', ''.join([str(i) for i in [i if i != 4 else 3 for i in ls]])):
-            r.append([i for i in range(i.start(), i.end())])
-    if 5 in element:
-        for i in re.finditer('5+', ''.join([str(i) for i in [i if i != 6 else 5 for i in ls]])):
-            r.append([i for i in range(i.start(), i.end())])
+    ls = np.asarray(ls, dtype=np.int64)
+    if ls.size == 0:
+        return []
+    # 1/2 -> 1 (cause), 3/4 -> 2 (effect), 5/6 -> 3 (cause and effect)
+    kind = (ls + 1) // 2
+    bounds = np.flatnonzero(kind[1:] != kind[:-1]) + 1
+    starts = np.concatenate(([0], bounds)).tolist()
+    ends = np.concatenate((bounds, [len(ls)])).tolist()
+    # a kind of span is only found if its B- tag occurs somewhere
+    present = set(ls[(ls % 2) == 1].tolist())
+    return [list(range(s, e)) for s, e in zip(starts, ends)
+            if 2*kind[s]-1 in present]
+
+
+class GapIndex:
+    """
+    Words between causality spans of one sentence, computed once per span pair
+    """
+
+    def __init__(self, sw, idx):
+        self.sw = sw
+        self.idx = idx
+        self._tokens = {}
+        self._text = {}
+        self._suffix = {}
+        self._has_cjc = {}
+
+    def tokens(self, i, j):
+        # sw[max(idx[i])+1:min(idx[j])]
+        if (i, j) not in self._tokens:
+            self._tokens[i, j] = self.sw[self.idx[i][-1]+1:self.idx[j][0]]
+        return self._tokens[i, j]
+
+    def text(self, i, j):
+        if (i, j) not in self._text:
+            self._text[i, j] = ' '.join(self.tokens(i, j))
+        return self._text[i, j]
+
+    def suffix(self, i):
+        # ' '.join(sw[min(idx[i]):])
+        if i not in self._suffix:
+            self._suffix[i] = ' '.join(self.sw[self.idx[i][0]:])
+        return self._suffix[i]
 
-    return sorted(r)
+    def has_conjunction(self, i, j, conjunction):
+        key = (i, j, conjunction)
+        if key not in self._has_cjc:
+            text = self.text(i, j)
+            self._has_cjc[key] = any(cjc in text for cjc in conjunction)
+        return self._has_cjc[key]
 
 
 def check_degree(num, edge, out_degree, in_degree):
@@ -42,10 +87,12 @@ def check_degree(num, edge, out_degree, in_degree):
         return 0
 
 
-def check_clause(sw, idx, out_degree, in_degree, cjc_idx, c_and_e):
+def check_clause(sw, idx, out_degree, in_degree, cjc_idx, c_and_e, gaps=None):
     """
     Check out clause
     """
+    if gaps is None:
+        gaps = GapIndex(sw, idx)
     if ',' not in sw:
         f_flag, b_flag = 0, 0
         for i in range(0, cjc_idx+2, 1):
@@ -59,20 +106,27 @@ def check_clause(sw, idx, out_degree, in_degree, cjc_idx, c_and_e):
         else:
             return 1
 
-    if [','] == sw[max(idx[cjc_idx])+1:min(idx[cjc_idx+1])]:
-        if ', and' not in ' '.join(sw[min(idx[cjc_idx+1]):]) and ', plus' not in ' '.join(sw[min(idx[cjc_idx+1]):]) and ', or' not in ' '.join(sw[min(idx[cjc_idx+1]):]):
+    if [','] == gaps.tokens(cjc_idx, cjc_idx+1):
+        suffix = gaps.suffix(cjc_idx+1)
+        if ', and' not in suffix and ', plus' not in suffix and ', or' not in suffix:
             return 1
 
     for i in c_and_e:
-        if i < cjc_idx and ',' not in sw[max(idx[i])+1:min(idx[cjc_idx])]:
+        if i < cjc_idx and ',' not in gaps.tokens(i, cjc_idx):
             return 0
     return 1
 
 
-def check_coordinating_cjc(sw, idx, edge, c_cjc, e_cjc, n_cjc):
+COORDINATING_CJC = (',', 'and', 'or', 'also', ';',
+                    'as well as', 'comparable with', 'either', 'plus')
+
+
+def check_coordinating_cjc(sw, idx, edge, c_cjc, e_cjc, n_cjc, gaps=None):
     """
     Check out coordinating conjunctions
     """
+    if gaps is None:
+        gaps = GapIndex(sw, idx)
     if c_cjc != []:
         for cj in c_cjc:
             if [e[-1] for e in edge if e[0] == cj] != [e[-1] for e in edge if e[0] == cj+1]:
@@ -90,175 +144,253 @@ def check_coordinating_cjc(sw, idx, edge, c_cjc, e_cjc, n_cjc):
                 if (e, nj+1) in edge:
                     return 0
 
-    conjunction = [',', 'and', 'or', 'also', ';',
-                   'as well as', 'comparable with', 'either', 'plus']
     for e1 in edge:
         for e2 in edge:
             if e1 != e2:
                 if e1[0] == e2[0]:
-                    count = 0
-                    for cjc in conjunction:
-                        if cjc not in ' '.join(sw[max(idx[min(e1[1], e2[1])])+1:min(idx[max(e1[1], e2[1])])]):
-                            count += 1
-                    if count == len(conjunction):
+                    if not gaps.has_conjunction(min(e1[1], e2[1]), max(e1[1], e2[1]), COORDINATING_CJC):
                         return 0
                 if e1[1] == e2[1]:
-                    count = 0
-                    for cjc in conjunction:
-                        if cjc not in ' '.join(sw[max(idx[min(e1[0], e2[0])])+1:min(idx[max(e1[0], e2[0])])]):
-                            count += 1
-                    if count == len(conjunction):
+                    if not gaps.has_conjunction(min(e1[0], e2[0]), max(e1[0], e2[0]), COORDINATING_CJC):
                         return 0
     return 1
 
 
-def rule_one(sw, out_degree, in_degree, idx, ls):
+RULE_ONE_CJC = (',', 'and', 'or', 'also', ';',
+                'as well as', 'comparable with', 'either')
+
+
+def rule_one(sw, out_degree, in_degree, idx, ls, gaps=None):
     """
     From tag sequence to final extracted results:
         one n-ary causal relation:
             C...E... (C >= 1 and E >= 1)
             E...C... (C >= 1 and E >= 1)
     """
+    if gaps is None:
+        gaps = GapIndex(sw, idx)
     edge = []
-    c_flag, e_flag = 0, 0
-    conjunction = [',', 'and', 'or', 'also', ';',
-                   'as well as', 'comparable with', 'either']
-    c_idx = [i.span()[0] for i in re.finditer(
-        '1', ''.join([str(i) for i in out_degree]))]
-    e_idx = [i.span()[0] for i in re.finditer(
-        '1', ''.join([str(i) for i in in_degree]))]
-    c_span = [(max(idx[c_idx[c]])+1, min(idx[c_idx[c+1]]))
-              for c in range(len(c_idx)-1)]
-    e_span = [(max(idx[e_idx[e]])+1, min(idx[e_idx[e+1]]))
-              for e in range(len(e_idx)-1)]
-    for s in c_span:
-        for cjc in conjunction:
-            if cjc in ' '.join([sw[i] for i in range(s[0], s[-1], 1)]):
-                c_flag += 1
-                break
-    for s in e_span:
-        for cjc in conjunction:
-            if cjc in ' '.join([sw[i] for i in range(s[0], s[-1], 1)]):
-                e_flag += 1
-                break
-    if c_flag == len(c_span) or e_flag == len(e_span) or sum(out_degree) == 1 or sum(in_degree) == 1:
+    c_idx = np.flatnonzero(out_degree).tolist()
+    e_idx = np.flatnonzero(in_degree).tolist()
+    c_flag = sum(gaps.has_conjunction(c_idx[c], c_idx[c+1], RULE_ONE_CJC)
+                 for c in range(len(c_idx)-1))
+    e_flag = sum(gaps.has_conjunction(e_idx[e], e_idx[e+1], RULE_ONE_CJC)
+                 for e in range(len(e_idx)-1))
+    if c_flag == len(c_idx[1:]) or e_flag == len(e_idx[1:]) or sum(out_degree) == 1 or sum(in_degree) == 1:
         for x in range(len(idx)):
             if out_degree[x] > 0:
                 for z in range(len(idx)):
                     if in_degree[z] > 0 and x != z:
                         edge.append((x, z))
     return edge
-    
 
-def rule_n(sw, ls, out_degree, in_degree, idx):
+
+CANDIDATE_CJC = (',', ';',
+                 'and', 'plus', 'also', 'to', 'then', 'of',
+                 ', and', 'and ,', 'plus ,', ', plus', ', also', 'also ,', ', of', 'of ,',
+                 '; and', 'and ;', 'plus ;', '; plus', '; also', 'also ;', '; of', 'of ;')
+
+
+def candidate_edges(sw, ls, out_degree, in_degree, idx, gaps=None):
     """
-    From tag sequence to final extracted results:
-        n-ary causal relation
+    Candidate edges and coordinating conjunctions for n-ary causal relations
     """
+    if gaps is None:
+        gaps = GapIndex(sw, idx)
     candidate, c_cjc, e_cjc, n_cjc = [], [], [], []
-    conjunction = [',', ';',
-                   'and', 'plus', 'also', 'to', 'then', 'of',
-                   ', and', 'and ,', 'plus ,', ', plus', ', also', 'also ,', ', of', 'of ,',
-                   '; and', 'and ;', 'plus ;', '; plus', '; also', 'also ;', '; of', 'of ;']
     c_and_e = [i for i in range(
         len(idx)) if out_degree[i] == 1 and in_degree[i] == 1]
     for i in range(len(idx)-1):
         if out_degree[i] != in_degree[i] and out_degree[i+1] != in_degree[i+1]:
-            for cjc in [',', 'or', 'and', 'plus']:
-                if out_degree[i] == 1 and out_degree[i+1] == 1:
-                    if sw[max(idx[i])+1:min(idx[i+1])][-1] == cjc and check_clause(sw, idx, out_degree, in_degree, i, c_and_e):
-                        c_cjc.append(i)
-                    for ce in c_and_e:
-                        if ce < i and i not in n_cjc and ',' not in sw[max(idx[ce])+1:min(idx[i])] and ' '.join(sw[max(idx[i])+1:min(idx[i+1])]) in [', and', ', plus', ', or']:
-                            n_cjc.append(i)
-                if in_degree[i] == 1 and in_degree[i+1] == 1:
-                    if sw[max(idx[i])+1:min(idx[i+1])][-1] == cjc and check_clause(sw, idx, out_degree, in_degree, i, c_and_e):
-                        e_cjc.append(i)
-                    for ce in c_and_e:
-                        if ce < i and i not in n_cjc and ',' not in sw[max(idx[ce])+1:min(idx[i])] and ' '.join(sw[max(idx[i])+1:min(idx[i+1])]) in [', and', ', plus', ', or']:
-                            n_cjc.append(i)
+            if out_degree[i] == 1 and out_degree[i+1] == 1:
+                cjc_list = c_cjc
+            elif in_degree[i] == 1 and in_degree[i+1] == 1:
+                cjc_list = e_cjc
+            else:
+                continue
+            if gaps.tokens(i, i+1)[-1] in (',', 'or', 'and', 'plus') and check_clause(sw, idx, out_degree, in_degree, i, c_and_e, gaps):
+                cjc_list.append(i)
+            for ce in c_and_e:
+                if ce < i and i not in n_cjc and ',' not in gaps.tokens(ce, i) and gaps.text(i, i+1) in (', and', ', plus', ', or'):
+                    n_cjc.append(i)
     for x in range(len(idx)):
         if out_degree[x] > 0:
             for z in range(len(idx)):
-                if in_degree[z] > 0:
-                    flag = 0
-                    if x > z:
-                        for cjc in conjunction:
-                            if cjc == ' '.join([sw[i] for i in range(max(idx[z])+1, min(idx[x]), 1)]):
-                                flag = 1
-                                break
-                        if flag == 0:
-                            candidate.append((x, z))
-                    elif x < z:
-                        for cjc in conjunction:
-                            if cjc == ' '.join([sw[i] for i in range(max(idx[x])+1, min(idx[z]), 1)]):
-                                flag = 1
-                                break
-                        if flag == 0:
-                            candidate.append((x, z))
-    record = []
-    for t in range(max(sum(out_degree), sum(in_degree)), len(candidate)+1, 1):
-        flag = 0
-        for i in combinations(candidate, t):
-            if check_degree(len(idx), i, out_degree, in_degree):
-                if 5 not in ls:
-                    record.append(([np.abs(e[0]-e[1])
-                                    for e in i], list(i)))
-                    flag = 1
-                else:
-                    if check_coordinating_cjc(sw, idx, i, c_cjc, e_cjc, n_cjc):
-                        record.append(
-                            (sum([np.abs(e[0]-e[1]) for e in i]), list(i)))
-                        flag = 1
-        if flag == 1:
-            break
-    if record != []:
-        return min(record)[-1]
-    else:
+                if in_degree[z] > 0 and x != z:
+                    if gaps.text(min(x, z), max(x, z)) not in CANDIDATE_CJC:
+                        candidate.append((x, z))
+    return candidate, c_cjc, e_cjc, n_cjc
+
+
+def nearest_edges(candidate, out_degree, in_degree):
+    """
+    Greedy fallback: link every cause and every effect through its shortest candidate edge
+    """
+    edge = set()
+    for x in range(len(out_degree)):
+        if out_degree[x] > 0:
+            e = [c for c in candidate if c[0] == x]
+            if e == []:
+                return 0
+            edge.add(min(e, key=lambda c: (np.abs(c[0]-c[1]), c)))
+    for z in range(len(in_degree)):
+        if in_degree[z] > 0 and z not in [e[1] for e in edge]:
+            e = [c for c in candidate if c[1] == z]
+            if e == []:
+                return 0
+            edge.add(min(e, key=lambda c: (np.abs(c[0]-c[1]), c)))
+    return sorted(edge)
+
+
+class SearchBudgetExceeded(Exception):
+    pass
+
+
+def search_edges(candidate, out_degree, in_degree, accept=None, budget=RULE_N_BUDGET):
+    """
+    Smallest set of candidate edges that gives every cause an out edge and
+    every effect an in edge, ranked by edge distances.
+
+    Visits edge sets in the order of itertools.combinations, but only those
+    that can still meet the degree constraints and beat the best set so far.
+    Without accept the edge distances are compared as a list, with accept
+    their sum is compared and a set is kept only if accept(edge) holds.
+    When the budget of visited states runs out, the best set found so far
+    is returned, which may not be the minimal one, or None if no set was
+    found yet.
+    """
+    sources = {x for x in range(len(out_degree)) if out_degree[x] > 0}
+    targets = {z for z in range(len(in_degree)) if in_degree[z] > 0}
+    dist = [int(np.abs(e[0]-e[1])) for e in candidate]
+    # last candidate position that can still cover each node
+    last_out, last_in = {}, {}
+    for i, e in enumerate(candidate):
+        last_out[e[0]] = i
+        last_in[e[1]] = i
+    if sources - set(last_out) or targets - set(last_in):
         return 0
 
+    visited = 0
+    best = None
+
+    def extend(t, start, chosen, out_count, in_count, total):
+        nonlocal visited, best
+        visited += 1
+        if visited > budget:
+            raise SearchBudgetExceeded
+        remaining = t - len(chosen)
+        if remaining == 0:
+            if out_count.keys() != sources or in_count.keys() != targets:
+                return
+            edge = [candidate[i] for i in chosen]
+            if accept is None:
+                key = [dist[i] for i in chosen]
+            else:
+                key = total
+            # later edge sets with an equal key are larger lists, so only a
+            # strictly smaller key can replace the best one
+            if best is not None and key >= best[0]:
+                return
+            if accept is not None and not accept(edge):
+                return
+            best = (key, edge)
+            return
+        uncovered_out = sources - out_count.keys()
+        uncovered_in = targets - in_count.keys()
+        if len(uncovered_out) > remaining or len(uncovered_in) > remaining:
+            return
+        if any(last_out[x] < start for x in uncovered_out) or any(last_in[z] < start for z in uncovered_in):
+            return
+        if best is not None:
+            if accept is None:
+                prefix = [dist[i] for i in chosen]
+                if prefix > best[0][:len(chosen)]:
+                    return
+            elif total + remaining >= best[0]:
+                return
+        for i in range(start, len(candidate) - remaining + 1):
+            x, z = candidate[i]
+            chosen.append(i)
+            out_count[x] = out_count.get(x, 0) + 1
+            in_count[z] = in_count.get(z, 0) + 1
+            extend(t, i+1, chosen, out_count, in_count, total + dist[i])
+            chosen.pop()
+            for count, node in ((out_count, x), (in_count, z)):
+                count[node] -= 1
+                if count[node] == 0:
+                    del count[node]
+
+    try:
+        for t in range(max(len(sources), len(targets)), len(candidate)+1, 1):
+            extend(t, 0, [], {}, {}, 0)
+            if best is not None:
+                return best[-1]
+    except SearchBudgetExceeded:
+        if best is not None:
+            return best[-1]
+        return None
+    return 0
+
+
+def rule_n(sw, ls, out_degree, in_degree, idx, budget=None, gaps=None):
+    """
+    From tag sequence to final extracted results:
+        n-ary causal relation
+    """
+    if budget is None:
+        budget = RULE_N_BUDGET
+    if gaps is None:
+        gaps = GapIndex(sw, idx)
+    candidate, c_cjc, e_cjc, n_cjc = candidate_edges(
+        sw, ls, out_degree, in_degree, idx, gaps)
+    if 5 not in ls:
+        accept = None
+    else:
+        def accept(edge):
+            return check_coordinating_cjc(sw, idx, edge, c_cjc, e_cjc, n_cjc, gaps)
+    edge = search_edges(candidate, out_degree, in_degree, accept, budget)
+    if edge is None:
+        # search budget ran out, fall back to the nearest candidate edges
+        # as long as they pass the same conjunction checks
+        edge = nearest_edges(candidate, out_degree, in_degree)
+        if edge != 0 and accept is not None and not accept(edge):
+            return 0
+    return edge
+
 
 def final_result(ls, sw):
     """
     From tag sequence to final extracted results
     """
     len_sen = len(sw)
-    ls = ls[:len_sen]
+    ls = np.asarray(ls)[:len_sen]
     idx = find_idx(ls)
     
-    if set(ls) == {0}:
+    if not ls.any():
         return 0
     
     if idx == []:
         return 0
     
-    out_degree, in_degree = [0]*len(idx), [0]*len(idx)
-    for i in range(len(idx)):
-        if ls[idx[i][0]] == 1:
-            out_degree[i] = 1
-        if ls[idx[i][0]] == 3:
-            in_degree[i] = 1
-        if ls[idx[i][0]] == 5:
-            out_degree[i] = 1
-            in_degree[i] = 1
+    first = ls[[i[0] for i in idx]]
+    out_degree = ((first == 1) | (first == 5)).astype(int).tolist()
+    in_degree = ((first == 3) | (first == 5)).astype(int).tolist()
     
     if sum(out_degree) == 0 or sum(in_degree) == 0:
         return 0
     
-    if 5 in ls:
+    has_ce = bool((ls == 5).any())
+    if has_ce:
         if sum(out_degree) < 2 or sum(in_degree) < 2:
             return 0
     
+    gaps = GapIndex(sw, idx)
     Edge = []
-    if 5 not in ls:
-        c = [i for i in re.finditer(
-            '1+', ''.join([str(i) for i in out_degree]))]
-        e = [i for i in re.finditer(
-            '1+', ''.join([str(i) for i in in_degree]))]
-        if len(c) == 1 and len(e) == 1:
-            Edge = rule_one(sw, out_degree, in_degree, idx, ls)
-    if 5 in ls or Edge == []:
-        Edge = rule_n(sw, ls, out_degree, in_degree, idx)
+    if not has_ce:
+        if len(find_runs(out_degree)[0]) == 1 and len(find_runs(in_degree)[0]) == 1:
+            Edge = rule_one(sw, out_degree, in_degree, idx, ls, gaps)
+    if has_ce or Edge == []:
+        Edge = rule_n(sw, ls, out_degree, in_degree, idx, gaps=gaps)
 
     if Edge == [] or Edge == 0:
         return 0
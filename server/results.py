@@ -0,0 +1,95 @@
+import os
+import json
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+RESULT_PARTS = ('nodes', 'edges', 'claims')
+
+
+def result_path(save_dir, job_id, part):
+    return os.path.join(save_dir, f"{job_id}_{part}.parquet")
+
+
+def summary_path(save_dir, job_id):
+    return os.path.join(save_dir, f"{job_id}_summary.json")
+
+
+def build_nodes(result_df):
+    # one node per cause/effect cluster with the number of edges touching it
+    clusters = pd.concat([result_df['cause_cluster'], result_df['effect_cluster']])
+    nodes = clusters.value_counts(sort=False).rename_axis('id').reset_index(name='size')
+    return nodes
+
+
+def save_results(save_dir, job_id, result_df, claims_df, topics, **summary):
+    # store the graph once in parquet so that clients fetch it in slices
+    # instead of receiving it whole over the socket
+    parts = {
+        'nodes': build_nodes(result_df),
+        'edges': result_df,
+        'claims': claims_df,
+    }
+    for part, df in parts.items():
+        df.reset_index(drop=True).to_parquet(
+            result_path(save_dir, job_id, part),
+            index=False
+        )
+
+    summary = {
+        'jobId': job_id,
+        **{part: len(df) for part, df in parts.items()},
+        **summary,
+    }
+    with open(summary_path(save_dir, job_id), 'w') as f:
+        json.dump({**summary, 'topics': topics}, f)
+    return summary
+
+
+def load_summary(save_dir, job_id):
+    try:
+        with open(summary_path(save_dir, job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_part(save_dir, job_id, part, offset=0, limit=None):
+    table = pq.read_table(result_path(save_dir, job_id, part), memory_map=True)
+    total = table.num_rows
+    table = table.slice(offset, limit)
+    return json.loads(table.to_pandas().to_json(orient="records")), total
+
+
+def read_claims(path):
+    claims_df = pd.read_parquet(path)
+    # nested lists come back from parquet as arrays
+    claims_df['pairs'] = [[list(pair) for pair in pairs] for pairs in claims_df['pairs']]
+    return claims_df
+
+
+def load_claims(save_dir, job_id):
+    return read_claims(result_path(save_dir, job_id, 'claims'))
+
+
+def shard_claims_path(save_dir, job_id, index):
+    return os.path.join(save_dir, f"{job_id}_shard{index}_claims.parquet")
+
+
+def save_shard_claims(save_dir, job_id, index, claims_df):
+    claims_df.reset_index(drop=True).to_parquet(
+        shard_claims_path(save_dir, job_id, index),
+        index=False
+    )
+
+
+def load_shard_claims(save_dir, job_id, index):
+    return read_claims(shard_claims_path(save_dir, job_id, index))
+
+
+def remove_shard_claims(save_dir, job_id, shards):
+    for index in range(shards):
+        try:
+            os.remove(shard_claims_path(save_dir, job_id, index))
+        except FileNotFoundError:
+            pass
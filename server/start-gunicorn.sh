@@ -4,7 +4,9 @@
 # pip install -r requirements.txt
 # cp -r /nas/home/iverma/causal-graph-pipeline/roberta-model-causal /nas/home/iverma/deploy/causal-graph-pipeline/roberta-model-causal
 # echo "UPLOAD_FOLDER=./data/" > .env
-# start a worker: rq worker --url redis://localhost:16379
+# start a worker that preloads the model: python worker.py
+# or: rq worker -w worker.PreloadedWorker --url redis://localhost:16379
+# with INFERENCE_SERVER_ADDRESS set in config.py, start the shared model first: python inference_server.py
 export PORT=12581
 export NUM_WORKERS=1
 export TIMEOUT=600
@@ -0,0 +1,29 @@
+from unittest import mock
+
+import relation_identification
+import legacy_relation_identification
+from benchmark import generate_tag_sequences, run_final_result
+
+
+def corpus():
+    # short sequences keep the exhaustive search of the original module fast
+    return generate_tag_sequences(1000, 3, 12, seed=0)
+
+
+def test_final_result_matches_original_module():
+    sequences = corpus()
+    expected = [
+        run_final_result(ls, sw, legacy_relation_identification.final_result)
+        for ls, sw in sequences
+    ]
+    # the original module always searched exhaustively
+    with mock.patch.object(relation_identification, 'RULE_N_BUDGET', float('inf')):
+        found = [run_final_result(ls, sw) for ls, sw in sequences]
+    assert found == expected
+
+
+def test_budget_does_not_change_short_sequences():
+    sequences = corpus()
+    with mock.patch.object(relation_identification, 'RULE_N_BUDGET', float('inf')):
+        exact = [run_final_result(ls, sw) for ls, sw in sequences]
+    assert [run_final_result(ls, sw) for ls, sw in sequences] == exact
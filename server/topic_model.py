@@ -1,163 +1,354 @@
+import os
+import pickle
 import string
+import hashlib
+from functools import lru_cache
 from nltk.stem import WordNetLemmatizer
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 from bertopic import BERTopic
+from sentence_transformers import SentenceTransformer
+from sklearn.feature_extraction.text import CountVectorizer
 from umap import UMAP
+import numpy as np
 import pandas as pd
 
+from cache import EmbeddingCache
+from dedup import collapse_entities
+from config import (
+    ENTITY_CACHE_SIZE,
+    EMBEDDING_MODEL,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    TOPIC_MODEL_DIR,
+    TOPIC_MODEL_DIR_MAX_BYTES,
+    CLUSTER_DRIFT_THRESHOLD,
+    ENTITY_DEDUP_DISTANCE,
+    ENTITY_DEDUP_NEIGHBORS,
+)
+
 
 lemmatizer = WordNetLemmatizer()
-stop_words = stopwords.words('english')
+stop_words = set(stopwords.words('english'))
+punctuation_table = str.maketrans('', '', string.punctuation)
 
 
 # preprocess entities to remove punctuation, stop words, and lemmatize
 def preprocess(entity, lemmatize=False, remove_stop_words=True):
-    result = []
-    cleaned_entity = entity.translate(
-        str.maketrans('', '', string.punctuation)
-    )
-    tokenized_entity = word_tokenize(cleaned_entity)
+    return normalize_entity(entity, lemmatize, remove_stop_words)
 
-    def process_token(token, lemmatize):
-        if lemmatize:
-            return lemmatizer.lemmatize(token.lower())
-        else:
-            return token.lower()
+
+# entities repeat a lot across claims, so normalized forms are memoized
+# per process, keyed by the raw entity and the flags
+@lru_cache(maxsize=ENTITY_CACHE_SIZE)
+def normalize_entity(entity, lemmatize, remove_stop_words):
+    result = []
+    tokenized_entity = word_tokenize(entity.translate(punctuation_table))
 
     for token in tokenized_entity:
-        if remove_stop_words:
-            if token.lower() not in stop_words:
-                result.append(process_token(token, lemmatize))
-        else:
-            result.append(process_token(token, lemmatize))
+        token = token.lower()
+        if remove_stop_words and token in stop_words:
+            continue
+        if lemmatize:
+            token = lemmatizer.lemmatize(token)
+        result.append(token)
 
     return " ".join(result)
 
 
+def preprocess_batch(entities, lemmatize=False, remove_stop_words=True):
+    # normalized form of every distinct entity
+    return {
+        entity: normalize_entity(entity, lemmatize, remove_stop_words)
+        for entity in set(entities)
+    }
+
+
+def explode_relations(roberta_df):
+    # one row per relation with the raw and normalized cause and effect,
+    # the text of each claim is carried along by its position
+    pairs = roberta_df['pairs'].reset_index(drop=True).explode().dropna()
+    relations = pd.DataFrame({
+        'cause': pairs.str[0].values,
+        'effect': pairs.str[1].values,
+        'text': roberta_df['text'].values[pairs.index.values],
+    })
+
+    entities = pd.unique(pd.concat([relations['cause'], relations['effect']]))
+    processed = preprocess_batch(entities)
+    relations['processed_cause'] = relations['cause'].map(processed)
+    relations['processed_effect'] = relations['effect'].map(processed)
+
+    # if the cause or effect are empty, then skip
+    keep = (relations['processed_cause'] != '') & (relations['processed_effect'] != '')
+    return relations.loc[keep].reset_index(drop=True), processed
+
+
+GRAPH_COLUMNS = ['cause', 'cause_cluster', 'effect', 'effect_cluster', 'text']
+
+
+def graph_frame(relations, cause_cluster, effect_cluster):
+    if relations.empty:
+        df = pd.DataFrame(columns=GRAPH_COLUMNS)
+    else:
+        df = pd.DataFrame({
+            'cause': relations['cause'],
+            'cause_cluster': cause_cluster,
+            'effect': relations['effect'],
+            'effect_cluster': effect_cluster,
+            'text': relations['text'],
+        })
+    df['id'] = df.index.values
+    return df
+
+
 def create_graph(roberta_df):
-    pairs = roberta_df['pairs'].values.tolist()
-    result = []
-    for i, pair in enumerate(pairs):
-        for relation in pair:
-            cause = relation[0]
-            effect = relation[1]
-
-            processed_cause = preprocess(cause)
-            processed_effect = preprocess(effect)
-
-            if processed_cause and processed_effect:
-                text = roberta_df.iloc[i]['text']
-                result.append([
-                    cause,
-                    processed_cause,
-                    effect,
-                    processed_effect,
-                    text
-                ])
-
-    result_df = pd.DataFrame(
-        result,
-        columns=[
-            'cause',
-            'cause_cluster',
-            'effect',
-            'effect_cluster',
-            'text'
-        ]
+    relations, _ = explode_relations(roberta_df)
+    return graph_frame(
+        relations,
+        relations['processed_cause'],
+        relations['processed_effect']
     )
-    result_df['id'] = result_df.index.values
-    return result_df
 
 
-def create_clustered_graph(roberta_df, nr_topics='auto', n_gram_range=(1, 2), top_n_words=10):
-    pairs = roberta_df['pairs'].values.tolist()
+@lru_cache(maxsize=None)
+def load_embedding_model(name):
+    return SentenceTransformer(name)
 
-    # extract all entities
-    entities = set()
-    for pair in pairs:
-        for relation in pair:
-            for entity in relation:
-                entities.add(entity)
 
-    processed_entities = []
-    for entity in entities:
-        processed_entity = preprocess(entity)
-        if processed_entity:
-            processed_entities.append(processed_entity)
+def embed_entities(entities):
+    # embeddings are cached by embedding model and normalized entity, so
+    # only entities not seen before go through the sentence transformer
+    cache = None
+    found = {}
+    if EMBEDDING_CACHE_PATH:
+        cache = EmbeddingCache(
+            EMBEDDING_CACHE_PATH,
+            EMBEDDING_MODEL,
+            EMBEDDING_CACHE_MAX_ENTRIES
+        )
+        found = cache.get_many(set(entities))
 
-    if len(processed_entities) == 0:
-        raise Exception("Could not find any entities to cluster")
+    missing = [entity for entity in dict.fromkeys(entities) if entity not in found]
+    if missing:
+        vectors = load_embedding_model(EMBEDDING_MODEL).encode(missing, show_progress_bar=False)
+        found.update(zip(missing, vectors))
+        if cache is not None:
+            cache.set_many(zip(missing, vectors))
 
-    # cluster entities
-    umap_model = UMAP(random_state=42)
-    topic_model = BERTopic(
-        nr_topics=nr_topics,
-        n_gram_range=n_gram_range,
-        top_n_words=top_n_words,
-        umap_model=umap_model
-    )
-    topics, probs = topic_model.fit_transform(processed_entities)
+    return np.vstack([found[entity] for entity in entities])
 
-    topic2docs = {topic: [] for topic in set(topics)}
-    doc2topic = {}
-    for topic, doc in zip(topics, processed_entities):
-        topic2docs[topic].append(doc)
 
-    for topic, docs in topic2docs.items():
-        for doc in docs:
-            doc2topic[doc] = topic
+def topic_model_path(docs, weights=None):
+    # with the collapse enabled, its settings and the mention weights that
+    # pick the canonical entities shape the fitted model as well
+    digest = hashlib.sha256(EMBEDDING_MODEL.encode())
+    digest.update(f"\0{ENTITY_DEDUP_DISTANCE}\0{ENTITY_DEDUP_NEIGHBORS}".encode())
+    for doc in docs:
+        digest.update(b"\0" + doc.encode())
+        if ENTITY_DEDUP_DISTANCE is not None:
+            digest.update(f"\0{weights.get(doc, 1) if weights else 1}".encode())
+    return os.path.join(TOPIC_MODEL_DIR, f"{digest.hexdigest()[:32]}.pickle")
+
+
+def load_topic_model(path):
+    # the mtime of a stored model doubles as its last access time
+    os.utime(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
 
-    result = []
 
-    for i, pair in enumerate(pairs):
-        for relation in pair:
-            cause = relation[0]
-            effect = relation[1]
-            processed_cause = preprocess(cause)
-            processed_effect = preprocess(effect)
+def save_topic_model(path, topic_model, topics):
+    # topic words are picked with the embedding model like they are
+    # without precomputed embeddings, it is attached again after loading
+    topic_model.custom_embeddings = False
+    topic_model.embedding_model = None
+    os.makedirs(TOPIC_MODEL_DIR, exist_ok=True)
+    with open(f"{path}.tmp", 'wb') as f:
+        pickle.dump((topic_model, topics), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+    evict_topic_models(keep=path)
 
-            # id_ = i
-            # label  = roberta_df.iloc[i]['label']
-            text = roberta_df.iloc[i]['text']
 
-            # if the cause or effect are empty, then skip
-            if (not processed_cause) or (not processed_effect):
+def evict_topic_models(keep):
+    # remove the least recently used models until the directory fits in
+    # TOPIC_MODEL_DIR_MAX_BYTES, the model just saved is always kept
+    models = []
+    for entry in os.scandir(TOPIC_MODEL_DIR):
+        if entry.name.endswith('.pickle'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
                 continue
+            models.append((stat.st_mtime, stat.st_size, entry.path))
 
-            cause_topic = doc2topic[processed_cause]
-            effect_topic = doc2topic[processed_effect]
-
-            result.append([
-                cause,
-                cause_topic,
-                effect,
-                effect_topic,
-                text
-            ])
-
-    df = pd.DataFrame(
-        result,
-        columns=[
-            'cause',
-            'cause_cluster',
-            'effect',
-            'effect_cluster',
-            'text'
-        ]
-    )
-    df['id'] = df.index.values
-    return df, topic_model.get_topics()
+    total = sum(size for _, size, _ in models)
+    for _, size, path in sorted(models):
+        if total <= TOPIC_MODEL_DIR_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def fit_base_topic_model(docs, weights=None, stats=None):
+    """
+    Fit or load the unreduced topic model of a set of entities.
+
+    The fitted model is kept on disk per set of entities, so re-clustering
+    a graph with another nr_topics, n_gram_range or top_n_words reuses its
+    embeddings, UMAP projection and clusters.
+
+    Near-duplicate entities are collapsed onto a canonical entity before
+    fitting, every entity then takes the topic of its canonical entity.
+    weights counts the mentions of each entity and picks the canonical one.
+    """
+    path = topic_model_path(docs, weights) if TOPIC_MODEL_DIR else None
+    if path is not None and os.path.exists(path):
+        topic_model, topics = load_topic_model(path)
+    else:
+        topic_model = BERTopic(umap_model=UMAP(random_state=42))
+        if ENTITY_DEDUP_DISTANCE is None:
+            topics, _ = topic_model.fit_transform(docs, embed_entities(docs))
+        else:
+            unique_docs = list(dict.fromkeys(docs))
+            embeddings = embed_entities(unique_docs)
+            canonical = collapse_entities(
+                unique_docs,
+                embeddings,
+                [weights.get(doc, 1) if weights else 1 for doc in unique_docs],
+                ENTITY_DEDUP_DISTANCE,
+                ENTITY_DEDUP_NEIGHBORS
+            )
+            fit_idx = sorted(set(canonical))
+            fit_topics, _ = topic_model.fit_transform(
+                [unique_docs[i] for i in fit_idx],
+                embeddings[fit_idx]
+            )
+            topic_of = dict(zip(fit_idx, fit_topics))
+            doc2topic = {
+                doc: topic_of[canonical[i]]
+                for i, doc in enumerate(unique_docs)
+            }
+            topics = [doc2topic[doc] for doc in docs]
+            if stats is not None:
+                stats['entities'] = len(unique_docs)
+                stats['canonical_entities'] = len(fit_idx)
+        if path is not None:
+            save_topic_model(path, topic_model, topics)
+
+    topic_model.embedding_model = load_embedding_model(EMBEDDING_MODEL)
+    return topic_model, topics
+
+
+def extend_base_topic_model(base_docs, base_weights, docs, weights, stats):
+    """
+    Assign the entities of docs that the stored model of base_docs has not
+    seen to its existing topics, without refitting. The weights are those
+    the models of base_docs and docs are stored under.
+
+    Returns None when there is no stored model for base_docs, when the new
+    entities outnumber the ones it was fitted on, or when more than
+    CLUSTER_DRIFT_THRESHOLD of them fall outside every topic.
+    """
+    path = topic_model_path(docs, weights)
+    base_path = topic_model_path(base_docs, base_weights)
+    if os.path.exists(path) or not os.path.exists(base_path):
+        return None
+
+    topic_model, base_topics = load_topic_model(base_path)
+    doc2topic = dict(zip(base_docs, base_topics))
+    new_docs = [doc for doc in dict.fromkeys(docs) if doc not in doc2topic]
+    stats['new_entities'] = len(new_docs)
+    if len(new_docs) > len(base_docs):
+        return None
+
+    if new_docs:
+        new_topics, _ = topic_model.transform(new_docs, embed_entities(new_docs))
+        stats['drift'] = sum(topic == -1 for topic in new_topics) / len(new_docs)
+        if stats['drift'] > CLUSTER_DRIFT_THRESHOLD:
+            return None
+        doc2topic.update(zip(new_docs, new_topics))
+
+    topics = [doc2topic[doc] for doc in docs]
+    topic_model._update_topic_size(pd.DataFrame({'Document': docs, 'Topic': topics}))
+    save_topic_model(path, topic_model, topics)
 
+    topic_model.embedding_model = load_embedding_model(EMBEDDING_MODEL)
+    return topic_model, topics
 
-def create_clustered_graph_json(graph, nr_topics, n_gram_range, top_n_words):
-    df = pd.read_json(graph)
 
-    result_df, topics = create_clustered_graph(
-        roberta_df=df,
-        nr_topics=nr_topics,
-        n_gram_range=n_gram_range,
-        top_n_words=top_n_words,
+def entity_weights(relations):
+    # number of mentions of every normalized entity
+    return pd.concat([
+        relations['processed_cause'],
+        relations['processed_effect'],
+    ]).value_counts().to_dict()
+
+
+def cluster_entities(processed):
+    processed_entities = []
+    for processed_entity in processed.values():
+        if processed_entity:
+            processed_entities.append(processed_entity)
+
+    # sorted so that the same graph maps to the same stored model
+    processed_entities.sort()
+    return processed_entities
+
+
+def create_clustered_graph(
+        roberta_df,
+        nr_topics='auto',
+        n_gram_range=(1, 2),
+        top_n_words=10,
+        base_df=None,
+        stats=None
+    ):
+    # extract all entities and normalize each of them once
+    relations, processed = explode_relations(roberta_df)
+    processed_entities = cluster_entities(processed)
+
+    if len(processed_entities) == 0:
+        raise Exception("Could not find any entities to cluster")
+
+    # cluster entities. when the claims extend an already clustered base
+    # graph, new entities are assigned to its topics unless they drifted
+    if stats is None:
+        stats = {}
+    weights = entity_weights(relations)
+    fitted = None
+    if base_df is not None and TOPIC_MODEL_DIR:
+        base_relations, base_processed = explode_relations(base_df)
+        fitted = extend_base_topic_model(
+            cluster_entities(base_processed),
+            entity_weights(base_relations),
+            processed_entities,
+            weights,
+            stats
+        )
+    stats['mode'] = 'incremental' if fitted is not None else 'fit'
+    if fitted is None:
+        fitted = fit_base_topic_model(processed_entities, weights, stats)
+    topic_model, topics = fitted
+
+    # only the topic representation and reduction depend on the parameters
+    topic_model.top_n_words = top_n_words
+    topic_model.n_gram_range = n_gram_range
+    topic_model.vectorizer_model = CountVectorizer(ngram_range=n_gram_range)
+    if nr_topics:
+        topics, _ = topic_model.reduce_topics(processed_entities, topics, nr_topics=nr_topics)
+    else:
+        topic_model.update_topics(processed_entities, topics, n_gram_range=n_gram_range)
+
+    doc2topic = dict(zip(processed_entities, topics))
+    df = graph_frame(
+        relations,
+        relations['processed_cause'].map(doc2topic),
+        relations['processed_effect'].map(doc2topic)
     )
-    result_df['id'] = result_df.index.values
-    return result_df.to_json(orient="records"), topics
+    return df, topic_model.get_topics()
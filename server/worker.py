@@ -1,5 +1,49 @@
+import time
 from redis import Redis
-from rq import Worker
+from rq import Worker, SimpleWorker
 
-w = Worker(['default'], connection=Redis(host='localhost', port=16379))
-w.work()
+from config import (
+    SAVED_MODEL_PATH,
+    NUM_THREADS,
+    MODEL_BACKEND,
+    ONNX_MODEL_PATH,
+    WORKER_FORK,
+    INFERENCE_SERVER_ADDRESS,
+)
+from model import ModelRunner
+
+
+class PreloadModelMixin:
+    # load the tokenizer and model once, before the worker takes any job.
+    # a forking worker shares them copy-on-write with every work horse,
+    # a simple worker runs its jobs in this process and keeps them loaded
+    def work(self, *args, **kwargs):
+        start = time.perf_counter()
+        if INFERENCE_SERVER_ADDRESS is not None:
+            # the inference server owns the model
+            ModelRunner.load_tokenizer(SAVED_MODEL_PATH)
+            self.log.info("Loaded tokenizer in %.2fs", time.perf_counter() - start)
+            return super().work(*args, **kwargs)
+        ModelRunner.load_model(
+            SAVED_MODEL_PATH,
+            NUM_THREADS,
+            backend=MODEL_BACKEND,
+            onnx_path=ONNX_MODEL_PATH
+        )
+        self.log.info("Loaded model in %.2fs", time.perf_counter() - start)
+        return super().work(*args, **kwargs)
+
+
+class PreloadedWorker(PreloadModelMixin, Worker):
+    pass
+
+
+class PreloadedSimpleWorker(PreloadModelMixin, SimpleWorker):
+    pass
+
+
+worker_class = PreloadedWorker if WORKER_FORK else PreloadedSimpleWorker
+
+if __name__ == "__main__":
+    w = worker_class(['default'], connection=Redis(host='localhost', port=16379))
+    w.work()